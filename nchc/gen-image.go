@@ -262,7 +262,7 @@ func FunLoadOvenImages(imgReq *LoadOvenImagesRequest) (*LoadOvenImagesResponse,
 func genVibrationTime(name string) ([]byte, error) {
 	sDir := filepath.Join(GetVariable("dataSourcePath"), name)
 	cmd1 := "python3"
-	args1 := []string{filepath.Join(scriptPath, "gen-vibration-time.py"), sDir}
+	args1 := []string{filepath.Join(scriptPath, scoringClient), "gen-vibration-time.py", sDir}
 	out1, err1 := runScript(cmd1, args1)
 	if err1 != nil {
 		log.Printf("failed to run script[%s]: %s", cmd1, err1)
@@ -275,7 +275,7 @@ func genVibrationTime(name string) ([]byte, error) {
 func genSFFTImages(curringName, axis, startTime, endTime, receta, datatype string) error {
 	sDir := filepath.Join(GetVariable("vibrationPath"))
 	cmd1 := "python3"
-	args1 := []string{filepath.Join(scriptPath, "gen-SFFT-image.py"), sDir, curringName, axis, startTime, endTime, receta, datatype}
+	args1 := []string{filepath.Join(scriptPath, scoringClient), "gen-SFFT-image.py", sDir, curringName, axis, startTime, endTime, receta, datatype}
 	out, err := runScript(cmd1, args1)
 	if err != nil {
 		log.Printf("failed to run script[%s]: %s", cmd1, err)
@@ -288,7 +288,7 @@ func genSFFTImages(curringName, axis, startTime, endTime, receta, datatype strin
 func genVibrationScore(curringName, axis, datatype string) (string, error) {
 	sfftsourceFile := filepath.Join(GetVariable("vibrationPath"), GetVariable("dataFileName3"))
 	cmd1 := "python3"
-	args1 := []string{filepath.Join(scriptPath, "vibration-anomaly-score.py"), curringName, axis, sfftsourceFile, datatype}
+	args1 := []string{filepath.Join(scriptPath, scoringClient), "vibration-anomaly-score.py", curringName, axis, sfftsourceFile, datatype}
 	out, err := runScript(cmd1, args1)
 	if err != nil {
 		log.Printf("failed to run script[%s]: %s", cmd1, err)
@@ -96,7 +96,7 @@ func genFanCurrentFile(name string, dataFileName string) ([]byte, error) {
 	sDir := filepath.Join(GetVariable("dataSourcePath"), name)
 	tDir := filepath.Join(GetVariable("dataSourcePath"), name, dataSubTmpDir)
 	cmd := "python3"
-	args := []string{filepath.Join(scriptPath, "analysisFanCurrent.py"), name, dataFileName, sDir, tDir, "./model"}
+	args := []string{filepath.Join(scriptPath, scoringClient), "analysisFanCurrent.py", name, dataFileName, sDir, tDir, "./model"}
 	out, err := runScript(cmd, args)
 	if err != nil {
 		log.Printf("failed to run script[%s]: %s", cmd, err)
@@ -110,7 +110,7 @@ func genHeaterCurrentFile(name string, dataFileName string) ([]byte, error) {
 	sDir := filepath.Join(GetVariable("dataSourcePath"), name)
 	tDir := filepath.Join(GetVariable("dataSourcePath"), name, dataSubTmpDir)
 	cmd := "python3"
-	args := []string{filepath.Join(scriptPath, "analysisHeaterCurrent.py"), name, dataFileName, sDir, tDir, "./model"}
+	args := []string{filepath.Join(scriptPath, scoringClient), "analysisHeaterCurrent.py", name, dataFileName, sDir, tDir, "./model"}
 	out, err := runScript(cmd, args)
 	if err != nil {
 		log.Printf("failed to run script[%s]: %s", cmd, err)
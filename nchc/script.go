@@ -6,6 +6,10 @@ import (
 	"strings"
 )
 
+// python scripts run through the scoring client, which hands them to
+// script/scoringDaemon.py when it is running and runs them directly otherwise
+const scoringClient = "scoringClient.py"
+
 func runScript(sName string, args []string) ([]byte, error) {
 	fmt.Printf("Running %s script: < %s >\n", sName, strings.Join(args, " , "))
 	cmd := exec.Command(sName, args...)
@@ -8,7 +8,9 @@ import re
 from currentLib import *
 
 if __name__ == "__main__":
-    curingName, dataFileName, sDir, tDir, mDir = sys.argv[1:]
+    curingName, dataFileName, sDir, tDir, mDir = sys.argv[1:6]
+    # rows per prediction block, bounds the (block x train) kernel matrix
+    blockSize = int(sys.argv[6]) if len(sys.argv) > 6 else 2048
     print(curingName, dataFileName, sDir, tDir, mDir)
     
     # check curing name
@@ -55,19 +57,14 @@ if __name__ == "__main__":
 
     # find model
     def findModel(mDir, autoclave, recipe):
-        models = loadModel(mDir, 'fan')
+        # only the requested model is loaded from the registry
         model = None
-        if autoclave in models:
-            #model = models[autoclave]
-
-            if recipe in models[autoclave]:
-                model = models[autoclave][recipe]
-                model_info['model_autoclave'] = autoclave
-                model_info['model_recipe'] = recipe
-            elif 'all' in models[autoclave]:
-                model = models[autoclave]['all']
+        for key in [recipe, 'all']:
+            model = loadRegistryModel(mDir, 'fan', autoclave, key)
+            if model is not None:
                 model_info['model_autoclave'] = autoclave
-                model_info['model_recipe'] = 'all'
+                model_info['model_recipe'] = key
+                break
         return model
 
     model = findModel(mDir, autoclave, curing.recipe)
@@ -90,7 +87,7 @@ if __name__ == "__main__":
     # predict data
     columns_model = []
     if model is not None:
-        mean, std = model.predict(x, return_std=True)
+        mean, std = predictChunked(model, x, block_size=blockSize)
         std = std[:,None]
         # insert to cc dataframe
         cc = cc.assign(
@@ -8,7 +8,9 @@ import re
 from currentLib import *
 
 if __name__ == "__main__":
-    curingName, dataFileName, sDir, tDir, mDir = sys.argv[1:]
+    curingName, dataFileName, sDir, tDir, mDir = sys.argv[1:6]
+    # rows per prediction block, bounds the (block x train) kernel matrix
+    blockSize = int(sys.argv[6]) if len(sys.argv) > 6 else 2048
     print(curingName, dataFileName, sDir, tDir, mDir)
     
     # check curing name
@@ -58,19 +60,14 @@ if __name__ == "__main__":
 
     # find model
     def findModel(mDir, autoclave, recipe, hid):
-        models = loadModel(mDir, 'heater')
+        # only the requested model is loaded from the registry
         model = None
-        if autoclave in models:
-            #model = models[autoclave]
-
-            if recipe + hid in models[autoclave]:
-                model = models[autoclave][recipe+hid]
-                model_info['model_autoclave'] = autoclave
-                model_info['model_recipe'] = recipe
-            elif 'all' + hid in models[autoclave]:
-                model = models[autoclave]['all'+hid]
+        for key in [recipe, 'all']:
+            model = loadRegistryModel(mDir, 'heater', autoclave, key + hid)
+            if model is not None:
                 model_info['model_autoclave'] = autoclave
-                model_info['model_recipe'] = 'all'
+                model_info['model_recipe'] = key
+                break
         return model
 
     model = findModel(mDir, autoclave, curing.recipe, heaterid)
@@ -93,7 +90,7 @@ if __name__ == "__main__":
     # predict data
     columns_model = []
     if model is not None:
-        mean, std = model.predict(x, return_std=True)
+        mean, std = predictChunked(model, x, block_size=blockSize)
         std = std[:,None]
 
         # insert to cc dataframe
@@ -0,0 +1,53 @@
+import os
+import sys
+import glob
+import argparse
+import logging
+from vibrationLib import compactVibrationDay, vibrationSettleSeconds
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s [%(levelname)-5.5s]  %(message)s",
+    handlers=[logging.StreamHandler()])
+
+logger         = logging.getLogger()
+vibrationPath  = 'vibrationData'
+sensorCodes    = ['500401', '500402', '500403', '500404', '500405']
+
+'''
+@param
+@return  parser(object)
+'''
+def processCommand():
+    parser = argparse.ArgumentParser(description='compact vibration csv files of a day into one archive per sensor')
+    parser.add_argument('--path', '-p', type=str, default=vibrationPath, help='vibration data path')
+    parser.add_argument('--day', '-d', type=str, nargs='*', default=None, help='days to compact (YYYY-MM-DD), all days by default')
+    parser.add_argument('--sensor', '-s', type=str, nargs='*', default=sensorCodes, help='sensor codes to compact')
+    parser.add_argument('--remove', action='store_true', help='remove the csv files after compaction')
+    parser.add_argument('--settle', type=float, default=vibrationSettleSeconds, help='seconds a csv is left unchanged before it is archived')
+    return parser.parse_args()
+
+def main():
+    args = processCommand()
+    if not os.path.isdir(args.path):
+        logger.error(args.path + ' directory not exist')
+        sys.exit(1)
+
+    if args.day:
+        days = [os.path.join(args.path, day) for day in args.day]
+    else:
+        days = sorted(d for d in glob.glob(os.path.join(args.path, '????-??-??')) if os.path.isdir(d))
+
+    for dayDir in days:
+        if not os.path.isdir(dayDir):
+            logger.warning(dayDir + ' directory not exist')
+            continue
+        for sensorCode in args.sensor:
+            try:
+                if compactVibrationDay(dayDir, sensorCode, removeSource=args.remove, settle=args.settle):
+                    logger.info('compact ' + dayDir + ' ' + sensorCode + ' successful')
+            except Exception as e:
+                logger.warning('compact ' + dayDir + ' ' + sensorCode + ' fail! ' + str(e))
+
+if __name__ == '__main__':
+    main()
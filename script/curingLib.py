@@ -0,0 +1,194 @@
+import os
+import re
+import glob
+import json
+import numpy as np
+import pandas as pd
+
+# parsed curing files are cached next to the source file, i.e. <dir>/.cache/Calc_<name>.csv.npz
+curingCacheDir = '.cache'
+curingEncoding = 'ISO-8859-1'
+curingTimeFormat = '%d/%m/%Y %H:%M:%S'
+# recipe index of the curing files under a directory, one json object per line
+curingIndexName = '.curingIndex.jsonl'
+curingIndexColumns = ['filename', 'autoclave', 'date', 'order', 'recipe', 'start', 'end', 'rows']
+# fields of every line of the index besides its path
+curingIndexKeys = curingIndexColumns[1:] + ['mtime', 'size']
+
+def __cachePath(filepath):
+    return os.path.join(os.path.dirname(filepath), curingCacheDir, os.path.basename(filepath) + '.npz')
+
+def __loadCache(filepath, stat):
+    cachePath = __cachePath(filepath)
+    if not os.path.isfile(cachePath):
+        return None
+    try:
+        with np.load(cachePath, allow_pickle=False) as cache:
+            if int(cache['mtime']) != stat.st_mtime_ns or int(cache['size']) != stat.st_size:
+                return None
+            receta = str(cache['recipe'])
+            columns = [str(c) for c in cache['columns']]
+            data = {}
+            for i, col in enumerate(columns):
+                values = cache['col_' + str(i)]
+                if values.dtype.kind == 'U':
+                    # string columns are stored without NaN, '' marks a missing value
+                    values = pd.Series(values, dtype=object).replace('', np.nan).values
+                data[col] = values
+            data['timestamp'] = cache['timestamp']
+    except Exception as e:
+        return None
+    return receta, pd.DataFrame(data, columns=columns + ['timestamp'])
+
+def __saveCache(filepath, stat, receta, df):
+    cachePath = __cachePath(filepath)
+    columns = [c for c in df.columns if c != 'timestamp']
+    arrays = {}
+    for i, col in enumerate(columns):
+        values = df[col]
+        if values.dtype == object:
+            values = values.where(values.notna(), '').astype(str)
+        arrays['col_' + str(i)] = values.values
+    tmpPath = '{}.{}.tmp.npz'.format(cachePath[:-4], os.getpid())
+    try:
+        if not os.path.isdir(os.path.dirname(cachePath)):
+            os.makedirs(os.path.dirname(cachePath), exist_ok=True)
+        np.savez(tmpPath,
+            mtime=np.int64(stat.st_mtime_ns), size=np.int64(stat.st_size),
+            recipe=np.array(receta), columns=np.array(columns, dtype=str),
+            timestamp=df['timestamp'].values, **arrays)
+        os.replace(tmpPath, cachePath)
+    except Exception as e:
+        # read-only data directory, the cache is only an optimization
+        if os.path.isfile(tmpPath):
+            os.remove(tmpPath)
+
+def parseCuringFile(filepath):
+    '''
+    @param   curing file path (Calc_<name>.csv)
+    @return  recipe(str), curing data(DataFrame) with a parsed timestamp column
+    '''
+    receta = pd.read_csv(filepath, encoding=curingEncoding, nrows=0).columns[1]
+    df = pd.read_csv(filepath, encoding=curingEncoding, skiprows=[0,1,2,4])
+    df = df.drop(columns=df.columns[-1], axis=1)
+    df = df.assign(timestamp=pd.to_datetime(df.Fecha + ' ' + df.Hora, format=curingTimeFormat))
+    return receta, df
+
+def readCuringFile(filepath, useCache=True):
+    '''
+    @param   curing file path (Calc_<name>.csv), use cache or not
+    @return  recipe(str), curing data(DataFrame) with a parsed timestamp column
+
+    The parsed result is cached by path + mtime + size, so a second read of
+    the same curing run loads the typed columns from one .npz file.
+    '''
+    stat = os.stat(filepath)
+    if useCache:
+        cached = __loadCache(filepath, stat)
+        if cached is not None:
+            return cached
+    receta, df = parseCuringFile(filepath)
+    if useCache:
+        __saveCache(filepath, stat, receta, df)
+    return receta, df
+
+def __indexEntry(filepath, stat):
+    result = re.search(r'Calc_(\w{2})(\d{8})-(\d{3})', os.path.basename(filepath))
+    clave, date, order = result.groups() if result else (None, None, None)
+    entry = {
+        'autoclave': clave, 'date': date, 'order': order,
+        'recipe': None, 'start': None, 'end': None, 'rows': 0,
+        'mtime': stat.st_mtime_ns, 'size': stat.st_size
+    }
+    try:
+        receta, df = readCuringFile(filepath)
+    except Exception as e:
+        return entry
+    entry['recipe'] = receta
+    entry['rows'] = int(df.shape[0])
+    if df.shape[0] > 0:
+        entry['start'] = df.timestamp.iloc[0].isoformat()
+        entry['end'] = df.timestamp.iloc[-1].isoformat()
+    return entry
+
+def __readIndex(indexPath):
+    entries = {}
+    if not os.path.isfile(indexPath):
+        return entries
+    with open(indexPath, 'r', encoding='utf-8') as f:
+        for line in f:
+            # a bad line is dropped, its file is indexed again
+            try:
+                entry = json.loads(line)
+                path = entry.pop('path')
+                if not all(key in entry for key in curingIndexKeys):
+                    continue
+            except (ValueError, KeyError, TypeError, AttributeError):
+                continue
+            entries[path] = entry
+    return entries
+
+def __writeIndex(indexPath, entries):
+    tmpPath = '{}.{}.tmp'.format(indexPath, os.getpid())
+    try:
+        with open(tmpPath, 'w', encoding='utf-8') as f:
+            for path in sorted(entries.keys()):
+                f.write(json.dumps(dict(path=path, **entries[path]), ensure_ascii=False) + '\n')
+        os.replace(tmpPath, indexPath)
+    except Exception as e:
+        if os.path.isfile(tmpPath):
+            os.remove(tmpPath)
+
+def updateCuringIndex(rootDir, pattern='Calc_*.csv'):
+    '''
+    @param   root directory of the index, glob pattern of curing files under it
+    @return  index of the matched curing files (DataFrame)
+
+    Only files that are new or whose mtime / size changed are parsed, the
+    rest comes from <rootDir>/.curingIndex.jsonl.
+    '''
+    indexPath = os.path.join(rootDir, curingIndexName)
+    entries = __readIndex(indexPath)
+    changed = False
+
+    files = sorted(glob.glob(os.path.join(rootDir, pattern)))
+    rows = []
+    for filepath in files:
+        if not os.path.isfile(filepath):
+            continue
+        path = os.path.relpath(filepath, rootDir)
+        stat = os.stat(filepath)
+        entry = entries.get(path)
+        if entry is None or entry['mtime'] != stat.st_mtime_ns or entry['size'] != stat.st_size:
+            entry = __indexEntry(filepath, stat)
+            entries[path] = entry
+            changed = True
+        rows.append(dict(filename=filepath, **entry))
+
+    # forget removed files
+    for path in [p for p in entries if not os.path.isfile(os.path.join(rootDir, p))]:
+        del entries[path]
+        changed = True
+
+    if changed:
+        __writeIndex(indexPath, entries)
+
+    return pd.DataFrame(rows, columns=curingIndexColumns)
+
+def findCuringFiles(rootDir, pattern='Calc_*.csv', autoclave=None, recipe=None, startDate=None, endDate=None):
+    '''
+    @param   root directory of the index, glob pattern, filters (date as YYYYMMDD)
+    @return  index of the curing files satisfy the filters (DataFrame)
+    '''
+    index = updateCuringIndex(rootDir, pattern)
+    dates = index.date.fillna('')
+    mask = index.rows > 0
+    if autoclave is not None:
+        mask &= index.autoclave == autoclave
+    if recipe is not None:
+        mask &= index.recipe == recipe
+    if startDate is not None:
+        mask &= dates >= startDate
+    if endDate is not None:
+        mask &= (dates != '') & (dates <= endDate)
+    return index[mask].reset_index(drop=True)
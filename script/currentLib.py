@@ -5,11 +5,15 @@ import os
 import time
 from sklearn.externals import joblib
 import json
+import hashlib
+import fcntl
+import contextlib
 from sklearn.gaussian_process import GaussianProcessRegressor
 from sklearn.gaussian_process.kernels import DotProduct, WhiteKernel, RBF, ConstantKernel
 import random
 import datetime
 from sklearn.metrics import mean_squared_error, r2_score
+from curingLib import readCuringFile, curingTimeFormat, updateCuringIndex
 
 def getCurrentData(Dir, fileName='current_fan.csv'):
     filepath = os.path.join(Dir, fileName)
@@ -45,9 +49,7 @@ def getCuringData(Dir, CuringName):
     try:
         if not os.path.isfile(filepath):
             raise Exception(filepath + ' is not exist!')
-        receta = pd.read_csv(filepath, encoding='ISO-8859-1', nrows=0).columns[1]
-        df = pd.read_csv(filepath, encoding='ISO-8859–1', skiprows=[0,1,2,4])
-        df = df.drop(columns=df.columns[-1], axis=1)
+        receta, df = readCuringFile(filepath)
         if df.shape[0] == 0:
             raise Exception(filepath + ' is nodata!')
         df.recipe = receta
@@ -67,102 +69,177 @@ def curing_preprocessing(curing, columns=['AMV', 'PMV']):
     if not 'timestamp' in __columns:
         __columns = ['timestamp'] + __columns
     
-    curing_n = curing.assign(timestamp=pd.to_datetime(curing.Fecha + ' ' + curing.Hora, format="%d/%m/%Y %H:%M:%S"), **slope)[ __columns ]
+    if 'timestamp' in curing.columns:
+        timestamp = curing.timestamp
+    else:
+        timestamp = pd.to_datetime(curing.Fecha + ' ' + curing.Hora, format=curingTimeFormat)
+    curing_n = curing.assign(timestamp=timestamp, **slope)[ __columns ]
     curing_n.recipe = curing.recipe
     curing_n.curingName = curing.curingName
     
     return curing_n
 
-def current_preprocessing(current, drop_duplicated=False, drop_zero=True, mean_size=0, mean_method='mean', drop_do_average=True):
-    current = current.copy()
+def current_preprocessing(current, drop_duplicated=False, drop_zero=True, mean_size=0, mean_method='mean', drop_do_average=True, mean_window=None):
     if drop_zero:
-        current = current[current.value != 0]   
-    # mark duplicated
-    dup_count = 0
-    cur = current
-    current_n = []
-    while True:
-        __tmp = cur[~cur.duplicated(keep='first', subset=['timestamp', 'addr'])]
-        current_n += [__tmp.assign(dup=dup_count)]
-        dup_count += 1
-        cur = cur[cur.duplicated(keep='first', subset=['timestamp', 'addr'])]
-        
-        if cur.empty:
-            break
-    
+        current = current[current.value != 0]
+
+    # mark duplicated, the n-th record of the same (timestamp, addr) gets dup = n
+    grouped = current.groupby(['timestamp', 'addr'], sort=False)
+    current = current[['timestamp', 'addr', 'value']].assign(dup=grouped.cumcount().values)
+
     extra_columns = []
     if drop_duplicated:
-        if drop_do_average:    
-            __tmp = current_n[0]
-            for i in range(1, len(current_n)):
-                __tmp = __tmp.merge(current_n[i], how='left', on=['timestamp', 'addr'], suffixes=('', str(i)))
-            current_n = __tmp
-            
-            all_values = current_n[current_n.columns.to_series().filter(like='value')].values
-            current_n = current_n.assign(
-                value=np.nanmean(all_values, axis=1),
-                var = np.nanvar(all_values, axis=1)
+        if drop_do_average:
+            # nanmean / nanvar over every duplicated record, kept on the first one
+            grouped = current.groupby(['timestamp', 'addr'], sort=False)['value']
+            current = current.assign(
+                value=grouped.transform('mean'),
+                var=grouped.transform('var', ddof=0)
             )
             extra_columns = ['var']
-        else:
-            current_n = current_n[0]
+        current_n = current[current.dup == 0]
     else:
-        current_n = pd.concat(current_n)
-        current_n = current_n.sort_values(by=['timestamp', 'dup', 'addr']) 
-    
+        current_n = current.sort_values(by=['timestamp', 'dup', 'addr'])
+
     # tranpose addr
     addrs = current_n.addr.unique()
     #addrs = np.delete(addrs, np.where(addrs == 35)[0])
-    
+
     if addrs.shape[0] == 0:
         return pd.DataFrame()
-    __tmp = [current_n[current_n.addr == addr][
-        ['timestamp', 'dup', 'value'] + extra_columns
-    ].rename(
-        columns={s:s+'_'+str(addr) for s in ['value']+extra_columns}
-    ) for addr in addrs]
-    
-    current_n = __tmp[0]
-    for i in range(1,len(__tmp)):
-        current_n = current_n.merge(__tmp[i], how='left', on=['timestamp', 'dup'])
-    current_n = current_n.fillna(method='ffill')
-    
-    if mean_size > 0 and mean_size < current_n.shape[0]:
+
+    # rows follow the (timestamp, dup) of the first addr, the others are left joined
+    cols = ['value'] + extra_columns
+    keys = pd.MultiIndex.from_frame(current_n.loc[current_n.addr == addrs[0], ['timestamp', 'dup']])
+    current_n = current_n.set_index(['timestamp', 'dup', 'addr'])[cols].unstack('addr')
+    current_n = current_n.reindex(index=keys, columns=[(s, addr) for addr in addrs for s in cols])
+    current_n.columns = [s+'_'+str(addr) for s, addr in current_n.columns]
+    current_n = current_n.reset_index().fillna(method='ffill')
+    
+    # moving mean (or rms) of every value / var column, over mean_window (a time span, e.g. '60s') if given, else mean_size samples
+    if mean_window is not None or (mean_size > 0 and mean_size < current_n.shape[0]):
         cols = ['value'] + extra_columns
-        cur = current_n[[s+'_'+str(addr) for s in cols for addr in addrs]].values
+        columns = [s+'_'+str(addr) for s in cols for addr in addrs]
+        cur = current_n[columns].values.astype(np.float64)
         
         if mean_method and mean_method.lower() == "rms":
-            cur = cur ** 2
-        
-        new_values = np.concatenate([np.convolve(cur[:,i], np.ones(mean_size)/mean_size,mode='vaild')[:,None] for i in range(cur.shape[1])], axis=1)
-        
-        frontend = int((mean_size - 1) / 2)
-        backend = mean_size - 1 - frontend
+            np.square(cur, out=cur)
         
-        cur[frontend:-backend, :] = new_values
-        new_values = cur
+        n = cur.shape[0]
+        if mean_window is not None:
+            # centered window of a time span, [t - span/2, t + span/2), shorter at both ends
+            span = pd.Timedelta(mean_window).value
+            ts = current_n.timestamp.values.astype('datetime64[ns]').astype(np.int64)
+            order = None
+            if not np.all(ts[1:] >= ts[:-1]):
+                order = np.argsort(ts, kind='stable')
+                ts, cur = ts[order], cur[order]
+            rows = np.arange(n)
+            lo = np.searchsorted(ts, ts - span // 2, side='left')
+            hi = np.maximum(np.searchsorted(ts, ts + (span - span // 2), side='left'), rows + 1)
+            cur = __movingMean(cur, rows, lo, hi)
+            if order is not None:
+                cur[order] = cur.copy()
+        else:
+            # centered window of mean_size samples, the first and last rows keep their values
+            frontend = int((mean_size - 1) / 2)
+            lo = np.arange(n - mean_size + 1)
+            cur = __movingMean(cur, lo + frontend, lo, lo + mean_size)
         
         if mean_method and mean_method.lower() == "rms":
-            new_values = np.sqrt(new_values)
+            np.sqrt(cur, out=cur)
         
-        current_n = current_n.assign(**{s+'_'+str(addr):new_values[:, idx + i*len(cols)] for i, s in enumerate(cols) for idx, addr in enumerate(addrs)})
+        current_n[columns] = cur
     
     return current_n
 
-def mergeCuringCurrent(curing, current, extend=False):
+def __movingMean(values, rows, lo, hi):
+    '''
+    @param   values (np.ndarray, samples x columns), rows to replace, first and end (exclusive) sample of their windows
+    @return  values, the rows replaced by the mean of their window, NaN if the window has a NaN as np.convolve
+
+    One cumulative sum over all the columns, every window is the difference of two of its rows.
+    '''
+    valid = ~np.isnan(values)
+    sums = np.zeros((values.shape[0] + 1, values.shape[1]))
+    np.cumsum(np.where(valid, values, 0), axis=0, out=sums[1:])
+    nans = np.zeros((values.shape[0] + 1, values.shape[1]), dtype=np.int64)
+    np.cumsum(~valid, axis=0, out=nans[1:])
+    means = (sums[hi] - sums[lo]) / (hi - lo)[:, None]
+    means[(nans[hi] - nans[lo]) > 0] = np.nan
+    values[rows] = means
+    return values
+
+def __asofIndex(left, right, tolerance, direction):
+    '''
+    @param   sorted int64 timestamps of both sides, tolerance (int64), direction ('backward', 'forward' or 'nearest')
+    @return  row of right matched by every row of left, -1 if none is within the tolerance
+    '''
+    n = right.shape[0]
+    backward = np.searchsorted(right, left, side='right') - 1
+    forward = np.searchsorted(right, left, side='left')
+    back_ok = backward >= 0
+    back_gap = np.where(back_ok, left - right[np.maximum(backward, 0)], 0)
+    back_ok &= back_gap <= tolerance
+    fwd_ok = forward < n
+    fwd_gap = np.where(fwd_ok, right[np.minimum(forward, n - 1)] - left, 0)
+    fwd_ok &= fwd_gap <= tolerance
+    if direction == 'backward':
+        return np.where(back_ok, backward, -1)
+    if direction == 'forward':
+        return np.where(fwd_ok, forward, -1)
+    if direction == 'nearest':
+        # ties go to the earlier record
+        use_fwd = fwd_ok & (~back_ok | (fwd_gap < back_gap))
+        return np.where(use_fwd, forward, np.where(back_ok, backward, -1))
+    raise ValueError('unknown direction ' + str(direction))
+
+def __sortedByTime(df):
+    if df.timestamp.is_monotonic_increasing:
+        return df.reset_index(drop=True)
+    return df.sort_values(by='timestamp', kind='mergesort').reset_index(drop=True)
+
+def mergeCuringCurrent(curing, current, extend=False, tolerance=None, direction='nearest'):
+    '''
+    @param   curing, current (DataFrame), extend (outer join filled forward and backward, or the pd.merge how),
+             tolerance (e.g. '1s') for an as-of merge, direction of the as-of match ('backward', 'forward' or 'nearest')
+    @return  curing and current of the same timestamps (DataFrame)
+
+    Without tolerance the timestamps must be equal. With a tolerance every
+    curing row takes the current record closest in the direction, if it is
+    within the tolerance, so clocks a second apart still align; the rows
+    come from curing and nothing larger than the two inputs is built.
+
+    The as-of merge keeps at most one current record per curing row. Of
+    current records with the same timestamp 'backward' and 'nearest' take
+    the last one, 'forward' the first one, while the exact merge gives a
+    row for every pair, so tolerance='0s' equals it only when the current
+    timestamps are unique.
+    '''
     if curing.empty or current.empty:
         return pd.DataFrame()
-    if extend:
-        if type(extend) == type(""):
-            how = extend
-        else:
-            how = 'outer'
+    if tolerance is not None:
+        left = __sortedByTime(curing)
+        right = __sortedByTime(current)
+        index = __asofIndex(
+            left.timestamp.values.astype('datetime64[ns]').astype(np.int64),
+            right.timestamp.values.astype('datetime64[ns]').astype(np.int64),
+            pd.Timedelta(tolerance).value, direction)
+        matched = index >= 0
+        right = right.drop(columns='timestamp').take(index[matched]).reset_index(drop=True)
+        cc = pd.concat([left[matched].reset_index(drop=True), right], axis=1)
     else:
-        how = 'inner'
-    cc = pd.merge(curing, current, how=how, on='timestamp', sort=True)
-    if extend:
-        cc = cc.fillna(method='ffill')
-        cc = cc.fillna(method='bfill')
+        if extend:
+            if type(extend) == type(""):
+                how = extend
+            else:
+                how = 'outer'
+        else:
+            how = 'inner'
+        cc = pd.merge(curing, current, how=how, on='timestamp', sort=True)
+        if extend:
+            cc = cc.fillna(method='ffill')
+            cc = cc.fillna(method='bfill')
     cc.recipe = curing.recipe
     cc.curingName = curing.curingName
     
@@ -171,21 +248,160 @@ def mergeCuringCurrent(curing, current, extend=False):
     return cc
 
 import re
-def ToolDataset(dataDir, device, chooseAutoclave=None, chooseRecipe=None, startDate=None, endDate=None):
-    #
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+def _loadRun(run):
     '''
-    data
-    - curing name (i.e OA20180829-001)
+    load curing and current data of a curing run
+    return None if the run has no usable data
+    '''
+    index, curingDir, curingName, currentFiles = run
+    curing = getCuringData(curingDir, curingName)
+    if curing.empty:
+        return None
+    curing = curing_preprocessing(curing)
+    
+    currents = {}
+    for device in ['fan', 'heater']:
+        if device not in currentFiles:
+            currents[device] = pd.DataFrame()
+            continue
+        currents[device] = getCurrentData(*os.path.split(currentFiles[device]))
+        if currents[device].empty:
+            return None
+    
+    return curing, currents['fan'], currents['heater']
+
+def _checkRun(run):
+    '''
+    cheap check of a lazy run: the curing file and the current files exist and
+    the current files have their columns and a record, nothing is parsed
+    (the curing index already holds the recipe and the rows of the curing file)
+    '''
+    index, curingDir, curingName, currentFiles = run
+    if not os.path.isfile(os.path.join(curingDir, 'Calc_'+curingName+'.csv')):
+        return False
+    for device, filepath in currentFiles.items():
+        try:
+            with open(filepath, 'r', encoding='utf-8') as f:
+                header = f.readline().strip().split(',')
+                record = f.readline().strip()
+        except (OSError, UnicodeDecodeError):
+            return False
+        if not all(col in header for col in ['timestamp', 'addr', 'value']) or record == '':
+            return False
+    return True
+
+class CuringDataset:
     '''
+    curing runs of a dataset, each row is loaded on access
+    - data_indexs: autoclave, date, order and recipe of each run
+    - dataset[i]: (curing, current_fan, current_heater) of the i-th run
+    at most cacheSize rows are kept in memory (None: keep all)
+    '''
+    def __init__(self, runs, cacheSize=None):
+        self.runs = runs
+        self.data_indexs = pd.DataFrame([run[0] for run in runs], columns=['autoclave', 'date', 'order', 'recipe'])
+        self.cacheSize = cacheSize
+        self.__cache = OrderedDict()
+    
+    def __len__(self):
+        return len(self.runs)
+    
+    def __getitem__(self, i):
+        if i in self.__cache:
+            self.__cache.move_to_end(i)
+            return self.__cache[i]
+        row = _loadRun(self.runs[i])
+        if row is None:
+            # only the files were checked when the dataset was built
+            print(self.runs[i][2], 'has no usable curing / current data')
+            row = (None, None, None)
+        if self.cacheSize is None or self.cacheSize > 0:
+            self.__cache[i] = row
+            if self.cacheSize is not None and len(self.__cache) > self.cacheSize:
+                self.__cache.popitem(last=False)
+        return row
+    
+    def astuple(self):
+        '''
+        compatibility view of (data_indexs, curing_datas, current_fan_datas, current_heater_datas)
+        '''
+        return (self.data_indexs, DatasetView(self, 0), DatasetView(self, 1), DatasetView(self, 2))
+
+class DatasetView:
+    '''
+    one column (curing / current_fan / current_heater) of a CuringDataset as a list
+    '''
+    def __init__(self, dataset, field):
+        self.dataset = dataset
+        self.field = field
+    
+    def __len__(self):
+        return len(self.dataset)
+    
+    def __getitem__(self, i):
+        return self.dataset[i][self.field]
+    
+    def __iter__(self):
+        for i in range(len(self.dataset)):
+            yield self[i]
+
+def buildDataset(runs, jobs=1, lazy=False, cacheSize=None):
+    '''
+    runs: list of ([autoclave, date, order, recipe], curing dir, curing name, {device: current file})
+    jobs: number of worker processes to parse runs
+    lazy: only check that the files of the runs are there, rows are parsed on access (see CuringDataset)
+    return (data_indexs, curing_datas, current_fan_datas, current_heater_datas)
+    '''
+    work = _checkRun if lazy else _loadRun
+    if jobs is not None and jobs > 1 and len(runs) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(work, runs, chunksize=max(1, len(runs) // (jobs * 4))))
+    else:
+        results = [work(run) for run in runs]
+    
+    if lazy:
+        return CuringDataset([run for run, ok in zip(runs, results) if ok], cacheSize).astuple()
+    
     curing_datas = []
     current_fan_datas = []
     current_heater_datas = []
-    
     data_indexs = []
+    for run, result in zip(runs, results):
+        if result is None:
+            continue
+        curing, current_fan, current_heater = result
+        # attributes do not survive pickling between processes
+        curing.recipe = run[0][3]
+        curing.curingName = run[2]
+        
+        curing_datas.append(curing)
+        current_fan_datas.append(current_fan)
+        current_heater_datas.append(current_heater)
+        data_indexs.append(run[0])
+    
+    data_indexs = pd.DataFrame(data_indexs, columns=['autoclave', 'date', 'order', 'recipe'])
+    return data_indexs, curing_datas, current_fan_datas, current_heater_datas
+
+def ToolDataset(dataDir, device, chooseAutoclave=None, chooseRecipe=None, startDate=None, endDate=None, jobs=1, lazy=False, cacheSize=None):
+    #
+    '''
+    data
+    - curing name (i.e OA20180829-001)
+    jobs, lazy, cacheSize: see buildDataset
+    '''
+    runs = []
     
     ignore_autoclave = 0
     ignore_recipe = 0
     
+    # recipe of each curing file, so other recipes are skipped without parsing
+    curing_index = updateCuringIndex(dataDir, os.path.join('*', 'Calc_'+(chooseAutoclave or '')+'*.csv'))
+    curing_index = curing_index[curing_index.rows > 0]
+    curing_recipes = dict(zip(curing_index.filename, curing_index.recipe))
+    
     for curing_name in os.listdir(dataDir):
         result = re.search('(\w{2})(\d{8})-(\d{3})', curing_name)
         if result:
@@ -204,42 +420,28 @@ def ToolDataset(dataDir, device, chooseAutoclave=None, chooseRecipe=None, startD
             ignore_autoclave += 1
             continue
         
-        if not os.path.isfile(os.path.join(dataDir, curing_name, 'Calc_'+clave+date+'-'+order+'.csv')):
+        curing_file = os.path.join(dataDir, curing_name, 'Calc_'+clave+date+'-'+order+'.csv')
+        # no file or no data
+        if curing_file not in curing_recipes:
             continue
         
-        curing = getCuringData(os.path.join(dataDir, curing_name), clave+date+'-'+order)
-        if curing.empty:
-            continue
-            
-        curing = curing_preprocessing(curing)
-        
-        if (chooseRecipe is not None) and curing.recipe != chooseRecipe:
+        recipe = curing_recipes[curing_file]
+        if (chooseRecipe is not None) and recipe != chooseRecipe:
             ignore_recipe += 1
             continue
         
         if device == "fan":
-            current_fan = getCurrentData(os.path.join(dataDir, curing_name), fileName="current_fan.csv")
-            current_heater = pd.DataFrame()
-            
-            if current_fan.empty:
-                continue
+            currentFiles = {'fan': os.path.join(dataDir, curing_name, "current_fan.csv")}
         elif "heater" in device:
-            current_fan = pd.DataFrame()
             heaterid = "".join(device.split("-")[1:2])
-            current_heater = getCurrentData(os.path.join(dataDir, curing_name), fileName="current_heater{}.csv".format(heaterid))
-            
-            if current_heater.empty:
-                continue
+            currentFiles = {'heater': os.path.join(dataDir, curing_name, "current_heater{}.csv".format(heaterid))}
         else:
             raise AttributeError("No device type for "+device)
         
-        curing_datas.append(curing)
-        current_fan_datas.append(current_fan)
-        current_heater_datas.append(current_heater)
-        
-        data_indexs.append([clave, date, order, curing.recipe])
+        runs.append(([clave, date, order, recipe], os.path.join(dataDir, curing_name), clave+date+'-'+order, currentFiles))
     
-    data_indexs = pd.DataFrame(data_indexs, columns=['autoclave', 'date', 'order', 'recipe'])
+    dataset = buildDataset(runs, jobs=jobs, lazy=lazy, cacheSize=cacheSize)
+    data_indexs = dataset[0]
     
     if data_indexs.empty:
         if ignore_autoclave and ignore_recipe:
@@ -249,15 +451,15 @@ def ToolDataset(dataDir, device, chooseAutoclave=None, chooseRecipe=None, startD
         elif ignore_recipe:
             raise FileNotFoundError('No data for {}'.format(chooseRecipe))
     
-    return data_indexs, curing_datas, current_fan_datas, current_heater_datas
+    return dataset
     
-def AIDCDataset(curingDir, currentDir, autoclaves = ['OA', 'OB', 'OC'], startDate=None, endDate=None):
-    curing_datas = []
-    current_fan_datas = []
-    current_heater_datas = []
-    data_indexs = []
+def AIDCDataset(curingDir, currentDir, autoclaves = ['OA', 'OB', 'OC'], startDate=None, endDate=None, chooseRecipe=None, jobs=1, lazy=False, cacheSize=None):
+    runs = []
     for autoclave in autoclaves:
         dirpath = os.path.join(curingDir, autoclave)
+        curing_index = updateCuringIndex(dirpath, 'Calc_'+autoclave+'*.csv')
+        curing_index = curing_index[curing_index.rows > 0]
+        curing_recipes = dict(zip(curing_index.filename, curing_index.recipe))
         a = list(os.listdir(dirpath))
         a.sort()
         for filename in a:
@@ -276,69 +478,150 @@ def AIDCDataset(curingDir, currentDir, autoclaves = ['OA', 'OB', 'OC'], startDat
             if (startDate is not None) and date < startDate:
                 continue
             
-            #print(clave, date, order)
+            # no data
+            recipe = curing_recipes.get(os.path.join(dirpath, filename))
+            if recipe is None:
+                continue
             
-            # get curing data
-            dirpath = os.path.join(curingDir, autoclave)
-            curing = getCuringData(dirpath, clave+date+'-'+order)
-            if curing.empty:
+            if (chooseRecipe is not None) and recipe != chooseRecipe:
                 continue
-                
-            # preprocess data
-            curing = curing_preprocessing(curing)
             
-            # get crrent fan and heater data
-            dirpath = os.path.join(currentDir, autoclave, clave+date+'-'+order)
-            current_fan = getCurrentData(dirpath, fileName="current_fan.csv")
-            current_heater = getCurrentData(dirpath, fileName='current_heater.csv')
+            #print(clave, date, order)
             
-            if (current_fan.empty or current_heater.empty):
-                continue
-                
-            curing_datas.append(curing)
-            current_heater_datas.append(current_heater)
-            current_fan_datas.append(current_fan)
+            # get crrent fan and heater data
+            currentpath = os.path.join(currentDir, autoclave, clave+date+'-'+order)
+            currentFiles = {
+                'fan': os.path.join(currentpath, "current_fan.csv"),
+                'heater': os.path.join(currentpath, "current_heater.csv")
+            }
             
-            data_indexs.append([clave, date, order, curing.recipe])        
-            #print(data_indexs)
-    data_indexs = pd.DataFrame(data_indexs, columns=['autoclave', 'date', 'order', 'recipe'])
-    #data_indexs.curing_datas = curing_datas
-    #data_indexs.current_heater_datas = current_heater_datas
-    #data_indexs.current_fan_datas = current_fan_datas
+            runs.append(([clave, date, order, recipe], dirpath, clave+date+'-'+order, currentFiles))
     
-    return data_indexs, curing_datas, current_fan_datas, current_heater_datas
+    return buildDataset(runs, jobs=jobs, lazy=lazy, cacheSize=cacheSize)
         
 __fanModelFileName = "fanCurrentModel.joblib"
 __heaterModelFileName = "heaterCurrentModel.joblib"
+# model registry: <mDir>/<name>.manifest.json maps autoclave -> key -> artifact under <mDir>/<name>/
+__manifestSuffix = ".manifest.json"
+__modelCache = {}
 
-def saveModel(model, mDir, device):
-    fn = None
+def __modelFileName(device):
     if device == 'fan':
-        fn = __fanModelFileName
+        return __fanModelFileName
     elif "heater" in device:
-        fn = __heaterModelFileName
+        return __heaterModelFileName
     else:
         raise AttributeError("No device type for "+device)
-    
-    filepath = os.path.join(mDir, fn)
-    joblib.dump(model, filepath)
+
+def __cachedLoad(fp, load):
+    # keep files warm in a long-lived process, reload when the file changes,
+    # keyed by the absolute path as the process serves callers of different working directories
+    mtime = os.stat(fp).st_mtime_ns
+    fp = os.path.abspath(fp)
+    if fp not in __modelCache or __modelCache[fp][0] != mtime:
+        __modelCache[fp] = (mtime, load(fp))
+    return __modelCache[fp][1]
+
+def __readManifest(fp):
+    with open(fp, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def __loadArtifact(fp):
+    # numpy arrays of the model (training data, Cholesky factor) are memory mapped
+    return joblib.load(fp, mmap_mode='r')
+
+def __atomicDump(obj, fp):
+    tmp = '{}.{}.tmp'.format(fp, os.getpid())
+    joblib.dump(obj, tmp)
+    os.replace(tmp, fp)
+
+@contextlib.contextmanager
+def __locked(path):
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def saveModel(model, mDir, device):
+    '''
+    store {autoclave: {key: model}} as one artifact per model plus a manifest
+    models loaded from the same artifact and not replaced are not written again
+
+    Writers hold <manifest>.lock from the first artifact to the pruning, and
+    keys another writer saved since this model was loaded are kept, so two
+    trainings of the same mDir do not delete each other's artifacts.
+    '''
+    name = os.path.splitext(__modelFileName(device))[0]
+    artifactDir = os.path.join(mDir, name)
+    if not os.path.isdir(artifactDir):
+        os.makedirs(artifactDir)
+    filepath = os.path.join(mDir, name + __manifestSuffix)
+    
+    with __locked(filepath):
+        manifest = {}
+        if os.path.isfile(filepath):
+            for autoclave, keys in __readManifest(filepath).items():
+                manifest[autoclave] = {key: artifact for key, artifact in keys.items() if os.path.isfile(os.path.join(mDir, artifact))}
+        for autoclave in model:
+            manifest.setdefault(autoclave, {})
+            for key, m in model[autoclave].items():
+                safe = re.sub(r'[^\w.-]', '_', '{}-{}'.format(autoclave, key))
+                digest = hashlib.md5('{}\0{}'.format(autoclave, key).encode('utf-8')).hexdigest()[:8]
+                artifact = os.path.join(name, '{}-{}.joblib'.format(safe, digest))
+                fp = os.path.join(mDir, artifact)
+                cached = __modelCache.get(os.path.abspath(fp))
+                if not (cached is not None and cached[1] is m and os.path.isfile(fp)):
+                    __atomicDump(m, fp)
+                manifest[autoclave][key] = artifact
+        
+        tmp = '{}.{}.tmp'.format(filepath, os.getpid())
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=1, sort_keys=True)
+        os.replace(tmp, filepath)
+        
+        # remove artifacts no manifest entry points to (e.g. left by an interrupted save)
+        used = set(os.path.basename(a) for keys in manifest.values() for a in keys.values())
+        for fn in os.listdir(artifactDir):
+            if fn.endswith('.joblib') and fn not in used:
+                os.remove(os.path.join(artifactDir, fn))
     return filepath
 
 def loadModel(mDir, device):
-    fn = None
-    if device == 'fan':
-        fn = __fanModelFileName
-    elif "heater" in device:
-        fn = __heaterModelFileName
-    else:
-        raise AttributeError("No device type for "+device)
+    '''
+    load every model {autoclave: {key: model}} of device
+    from the registry, or from the single joblib file of older model directories
+    '''
+    fn = __modelFileName(device)
+    manifestPath = os.path.join(mDir, os.path.splitext(fn)[0] + __manifestSuffix)
+    if os.path.isfile(manifestPath):
+        manifest = __cachedLoad(manifestPath, __readManifest)
+        return {
+            autoclave: {key: __cachedLoad(os.path.join(mDir, artifact), __loadArtifact) for key, artifact in keys.items()}
+            for autoclave, keys in manifest.items()
+        }
     
     fp = os.path.join(mDir, fn)
     if os.path.isfile(fp):
-        return joblib.load(fp)
+        return __cachedLoad(fp, joblib.load)
     else:
         return {}
 
+def loadRegistryModel(mDir, device, autoclave, key):
+    '''
+    load only the model of (device, autoclave, key), None if there is none
+    '''
+    fn = __modelFileName(device)
+    manifestPath = os.path.join(mDir, os.path.splitext(fn)[0] + __manifestSuffix)
+    if os.path.isfile(manifestPath):
+        artifact = __cachedLoad(manifestPath, __readManifest).get(autoclave, {}).get(key)
+        if artifact is None or not os.path.isfile(os.path.join(mDir, artifact)):
+            return None
+        return __cachedLoad(os.path.join(mDir, artifact), __loadArtifact)
+    
+    return loadModel(mDir, device).get(autoclave, {}).get(key)
+
 def getDataFromRaw(cc, x_feature=None, y_feature=None):
     if not x_feature:
         x_feature = ['PMV', 'AMV']
@@ -381,9 +664,236 @@ def divideData(di, size=None, method='random'):
     
     return train_di, test_di
 
+from scipy.linalg import cholesky, cho_solve, solve_triangular
+from sklearn.base import BaseEstimator, RegressorMixin, clone
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.utils import check_random_state
+
+def _jitterCholesky(K):
+    # add growing jitter until K is numerically positive definite
+    jitter = 0
+    scale = np.mean(np.diag(K))
+    for _ in range(8):
+        try:
+            return cholesky(K + jitter * np.eye(K.shape[0]), lower=True)
+        except np.linalg.LinAlgError:
+            jitter = scale * 1e-10 if jitter == 0 else jitter * 10
+    return cholesky(K + jitter * np.eye(K.shape[0]), lower=True)
+
+class SparseGPRegressor(BaseEstimator, RegressorMixin):
+    '''
+    Gaussian process regression on m inducing points
+    - kernel hyperparameters are optimized by an exact GaussianProcessRegressor
+      on n_hyper rows chosen without replacement
+    - inducing points are chosen by 'kmeans', 'greedy' (farthest point) or 'random'
+    - mean is the subset of regressors predictor, std is Nystrom corrected (DTC)
+    training costs O(n m^2) time and O(m^2) memory besides the data
+    '''
+    def __init__(self, kernel=None, n_inducing=500, inducing='kmeans', n_hyper=2000,
+                 optimizer='fmin_l_bfgs_b', n_restarts_optimizer=0, normalize_y=False,
+                 alpha=1e-10, block_size=10000, random_state=None):
+        self.kernel = kernel
+        self.n_inducing = n_inducing
+        self.inducing = inducing
+        self.n_hyper = n_hyper
+        self.optimizer = optimizer
+        self.n_restarts_optimizer = n_restarts_optimizer
+        self.normalize_y = normalize_y
+        self.alpha = alpha
+        self.block_size = block_size
+        self.random_state = random_state
+    
+    def _select_inducing(self, X, rng):
+        m = min(self.n_inducing, X.shape[0])
+        if self.inducing == 'kmeans':
+            km = MiniBatchKMeans(n_clusters=m, random_state=rng.randint(np.iinfo(np.int32).max))
+            return km.fit(X).cluster_centers_
+        elif self.inducing == 'greedy':
+            # farthest point traversal over a random candidate set
+            candidates = X[rng.choice(X.shape[0], min(X.shape[0], 50 * m), replace=False)]
+            chosen = [rng.randint(candidates.shape[0])]
+            dist = np.sum((candidates - candidates[chosen[0]]) ** 2, axis=1)
+            for _ in range(1, m):
+                chosen.append(int(np.argmax(dist)))
+                dist = np.minimum(dist, np.sum((candidates - candidates[chosen[-1]]) ** 2, axis=1))
+            return candidates[chosen]
+        elif self.inducing == 'random':
+            return X[rng.choice(X.shape[0], m, replace=False)]
+        raise AttributeError('No inducing method for {}'.format(self.inducing))
+    
+    def fit(self, X, y):
+        X = np.asarray(X, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        rng = check_random_state(self.random_state)
+        
+        if self.kernel is None:
+            kernel = ConstantKernel(1.0, constant_value_bounds="fixed") * RBF(1.0, length_scale_bounds="fixed")
+        else:
+            kernel = clone(self.kernel)
+        
+        self._y_train_mean = np.mean(y, axis=0) if self.normalize_y else np.zeros(y.shape[1:])
+        y = y - self._y_train_mean
+        
+        # kernel hyperparameters from an exact GP on a subset
+        if self.optimizer is not None and kernel.n_dims > 0:
+            idxs = np.sort(rng.choice(X.shape[0], min(self.n_hyper, X.shape[0]), replace=False))
+            gpr = GaussianProcessRegressor(
+                kernel=kernel, alpha=self.alpha, optimizer=self.optimizer,
+                n_restarts_optimizer=self.n_restarts_optimizer, copy_X_train=False,
+                random_state=rng
+            )
+            gpr.fit(X[idxs], y[idxs])
+            self.kernel_ = gpr.kernel_
+        else:
+            self.kernel_ = kernel
+        
+        self.X_inducing_ = self._select_inducing(X, rng)
+        m = self.X_inducing_.shape[0]
+        
+        # white noise only shows up on k(x, x), not on k(x, y)
+        self.noise_ = self.kernel_.diag(X[:1])[0] - self.kernel_(X[:1], X[:1])[0, 0] + self.alpha
+        self.noise_ = max(self.noise_, self.alpha)
+        
+        Kmm = self.kernel_(self.X_inducing_, self.X_inducing_)
+        self.L_mm_ = _jitterCholesky(Kmm)
+        
+        # with V = L_mm^-1 Kmn, B = V V^T + noise I is well conditioned
+        VVt = np.zeros((m, m))
+        Vy = np.zeros((m,) + y.shape[1:])
+        for start in range(0, X.shape[0], self.block_size):
+            Knm = self.kernel_(X[start:start + self.block_size], self.X_inducing_)
+            V = solve_triangular(self.L_mm_, Knm.T, lower=True)
+            VVt += V.dot(V.T)
+            Vy += V.dot(y[start:start + self.block_size])
+        
+        VVt[np.diag_indices_from(VVt)] += self.noise_
+        self.L_B_ = _jitterCholesky(VVt)
+        self.alpha_ = solve_triangular(self.L_mm_.T, cho_solve((self.L_B_, True), Vy), lower=False)
+        return self
+    
+    def predict(self, X, return_std=False):
+        X = np.asarray(X, dtype=np.float64)
+        mean = np.empty((X.shape[0],) + self.alpha_.shape[1:])
+        std = np.empty(X.shape[0])
+        for start in range(0, X.shape[0], self.block_size):
+            x = X[start:start + self.block_size]
+            Kxm = self.kernel_(x, self.X_inducing_)
+            mean[start:start + self.block_size] = Kxm.dot(self.alpha_) + self._y_train_mean
+            if return_std:
+                W = solve_triangular(self.L_mm_, Kxm.T, lower=True)
+                U = solve_triangular(self.L_B_, W, lower=True)
+                var = self.kernel_.diag(x) - np.sum(W ** 2, axis=0) + self.noise_ * np.sum(U ** 2, axis=0)
+                std[start:start + self.block_size] = np.sqrt(np.maximum(var, 0))
+        if return_std:
+            return mean, std
+        return mean
+
+_searchData = {}
+
+def _setSearchData(datasets):
+    global _searchData
+    _searchData = datasets
+
+def _fitCandidate(task):
+    key, c, r, model = task
+    x, y = _searchData[key]
+    model.fit(x, y)
+    lml = getattr(model, 'log_marginal_likelihood_value_', 0.0)
+    return key, c, r, model, lml, model.score(x, y)
+
+def searchModels(datasets, candidates, jobs=1, seed=None):
+    '''
+    datasets: {key: (x, y)}, candidates: unfitted estimators
+    every optimizer restart of a GaussianProcessRegressor candidate is fitted as
+    its own task, with initial theta drawn from seed, so results do not depend on jobs
+    return {key: model}, restart kept by log marginal likelihood and candidate by score
+    '''
+    rng = np.random.RandomState(seed)
+    tasks = []
+    for key in datasets:
+        for c, candidate in enumerate(candidates):
+            restarts = 0
+            if isinstance(candidate, GaussianProcessRegressor) and candidate.optimizer is not None:
+                restarts = candidate.n_restarts_optimizer
+            for r in range(restarts + 1):
+                model = clone(candidate)
+                if isinstance(candidate, GaussianProcessRegressor):
+                    if r > 0:
+                        bounds = candidate.kernel.bounds
+                        if not np.isfinite(bounds).all():
+                            raise ValueError('Optimizer restarts need finite kernel bounds')
+                        model.set_params(kernel=candidate.kernel.clone_with_theta(rng.uniform(bounds[:, 0], bounds[:, 1])))
+                    model.set_params(n_restarts_optimizer=0)
+                model.set_params(random_state=rng.randint(np.iinfo(np.int32).max))
+                tasks.append((key, c, r, model))
+    
+    if jobs is not None and jobs > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_setSearchData, initargs=(datasets,)) as executor:
+            results = list(executor.map(_fitCandidate, tasks))
+    else:
+        _setSearchData(datasets)
+        results = [_fitCandidate(task) for task in tasks]
+        _setSearchData({})
+    
+    # best restart of each candidate
+    best = {}
+    for key, c, r, model, lml, score in results:
+        if (key, c) not in best or lml > best[(key, c)][1]:
+            best[(key, c)] = (model, lml, score)
+    
+    models = {}
+    for key in datasets:
+        scores = [best[(key, c)][2] for c in range(len(candidates))]
+        model = best[(key, np.argmax(scores))][0]
+        params = candidates[np.argmax(scores)].get_params(deep=False)
+        if isinstance(model, GaussianProcessRegressor):
+            model.set_params(kernel=params['kernel'], n_restarts_optimizer=params['n_restarts_optimizer'])
+        models[key] = model
+    
+    return models
+
+def predictChunked(model, x, block_size=2048, use_cholesky=True):
+    '''
+    mean and std of model on x, computed block_size rows at a time into
+    preallocated arrays so the kernel cross matrix stays (block_size x n_train)
+    use_cholesky: std of a GaussianProcessRegressor comes from its cached
+    Cholesky factor L_ instead of the inverse of the training kernel matrix
+    '''
+    n = x.shape[0]
+    mean = None
+    std = None
+    
+    # the Cholesky path only matches predict() when y is not scaled
+    if not isinstance(model, GaussianProcessRegressor) or not np.all(getattr(model, '_y_train_std', 1) == 1):
+        use_cholesky = False
+    
+    for start in range(0, n, block_size):
+        xb = x[start:start + block_size]
+        if use_cholesky:
+            K_trans = model.kernel_(xb, model.X_train_)
+            mean_b = K_trans.dot(model.alpha_) + getattr(model, '_y_train_mean', 0)
+            v = solve_triangular(model.L_, K_trans.T, lower=True)
+            var_b = model.kernel_.diag(xb) - np.einsum('ij,ij->j', v, v)
+            std_b = np.sqrt(np.maximum(var_b, 0))
+        else:
+            mean_b, std_b = model.predict(xb, return_std=True)
+        if mean is None:
+            mean = np.empty((n,) + mean_b.shape[1:])
+            std = np.empty((n,) + std_b.shape[1:])
+        mean[start:start + block_size] = mean_b
+        std[start:start + block_size] = std_b
+    
+    if mean is None:
+        return model.predict(x, return_std=True)
+    return mean, std
+
 __kernel = WhiteKernel(10) + DotProduct(100) + RBF(10)
 __max_train_size = 5000
-def makeModel(cc_datas, recipe_list, x_feature=None, y_feature=None, show=False, down_sampling=True, n_restarts_optimizer=0):
+def makeModel(cc_datas, recipe_list, x_feature=None, y_feature=None, show=False, down_sampling=True, n_restarts_optimizer=0, sparse=False, n_inducing=500):
+    '''
+    sparse: train SparseGPRegressor with n_inducing inducing points on all data
+    instead of an exact GP on at most __max_train_size random rows
+    '''
     model = {}
     all_x = []
     all_y = []
@@ -398,9 +908,9 @@ def makeModel(cc_datas, recipe_list, x_feature=None, y_feature=None, show=False,
         
         train_x, train_y = getDataFromRaw(cc_datas[indexs[train_i]], x_feature, y_feature)
         
-        if down_sampling and train_x.shape[0] > __max_train_size:
+        if down_sampling and not sparse and train_x.shape[0] > __max_train_size:
             show_msg += ['origin: train x : {}, train y : {}'.format(train_x.shape, train_y.shape)]
-            rand_idxs = np.sort(np.random.randint(0, train_x.shape[0], __max_train_size))
+            rand_idxs = np.sort(np.random.choice(train_x.shape[0], __max_train_size, replace=False))
             train_x = train_x[rand_idxs, :]
             train_y = train_y[rand_idxs, :]
             
@@ -410,10 +920,16 @@ def makeModel(cc_datas, recipe_list, x_feature=None, y_feature=None, show=False,
         if show:
             print('\n'.join(show_msg))
         
-        gpr = GaussianProcessRegressor(
-            kernel=__kernel, copy_X_train=copy_x,
-            n_restarts_optimizer = n_restarts_optimizer
-        )
+        if sparse:
+            gpr = SparseGPRegressor(
+                kernel=__kernel, n_inducing=n_inducing,
+                n_restarts_optimizer = n_restarts_optimizer
+            )
+        else:
+            gpr = GaussianProcessRegressor(
+                kernel=__kernel, copy_X_train=copy_x,
+                n_restarts_optimizer = n_restarts_optimizer
+            )
         gpr.fit(train_x, train_y)
         mean, std = gpr.predict(train_x, return_std=True)
         std = std[:,None]
@@ -438,7 +954,7 @@ def makeModel(cc_datas, recipe_list, x_feature=None, y_feature=None, show=False,
     # if data set to big, don't train kernel parameter
     optimizer = {}
     all_kernel = __kernel
-    if all_x.shape[0] >= __max_train_size*2:
+    if not sparse and all_x.shape[0] >= __max_train_size*2:
         optimizer['optimizer'] = None
         # get each model parameter
         all_theta = [gpr.kernel_.theta for _, gpr in model.items()]
@@ -447,7 +963,7 @@ def makeModel(cc_datas, recipe_list, x_feature=None, y_feature=None, show=False,
         all_theta = np.mean(all_theta, axis=0)
         all_kernel = __kernel.clone_with_theta(all_theta)
         
-        rand_idxs = np.sort(np.random.randint(0, all_x.shape[0], __max_train_size*2))
+        rand_idxs = np.sort(np.random.choice(all_x.shape[0], __max_train_size*2, replace=False))
         
         all_x = all_x[rand_idxs, :]
         all_y = all_y[rand_idxs, :]
@@ -456,9 +972,14 @@ def makeModel(cc_datas, recipe_list, x_feature=None, y_feature=None, show=False,
         print('ALL RECIPE')
         print('train x : ', all_x.shape, ', train y : ', all_y.shape)    
         
-    gpr = GaussianProcessRegressor(
-        kernel=all_kernel, copy_X_train=copy_x,
-        n_restarts_optimizer = n_restarts_optimizer, **optimizer)
+    if sparse:
+        gpr = SparseGPRegressor(
+            kernel=all_kernel, n_inducing=n_inducing,
+            n_restarts_optimizer = n_restarts_optimizer)
+    else:
+        gpr = GaussianProcessRegressor(
+            kernel=all_kernel, copy_X_train=copy_x,
+            n_restarts_optimizer = n_restarts_optimizer, **optimizer)
     gpr.fit(all_x, all_y)
     mean, std = gpr.predict(all_x, return_std=True)
     std = std[:,None]
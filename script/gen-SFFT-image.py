@@ -1,101 +1,120 @@
 import sys
-import glob
-import time
 import os
 import numpy as np
 import pandas as pd
 import datetime
-from matplotlib import pyplot as plt
-from scipy import signal
-from sklearn.externals import joblib
-from sklearn.decomposition import PCA
+import matplotlib
+matplotlib.use('Agg')
+from vibrationLib import lookupSelectFrequency, vibrationSpectrogram, findVibrationFiles, vibrationTimeFormat, spectrogramCacheName
+from vibrationLib import loadVibrationModel, vibrationModelName, vibrationModelSignature, scoreVibrationModel
+from vibrationLib import saveVibrationFeatures, vibrationFeaturesSuffix
 
-def select_frequecy(recipe,axis,datatype):
+def findVibrationModel(recipe,axis,datatype,oven):
+    if oven is None:
+        return None
+    bundle = loadVibrationModel(vibrationModelName(recipe, oven, axis, datatype))
+    if bundle is None or bundle['frequency'] is None:
+        return None
+    return bundle
+def select_frequecy(recipe,axis,datatype,oven=None):
+    # the trained bundle carries its frequencies, Select_Frequency.csv serves older models
+    bundle = findVibrationModel(recipe,axis,datatype,oven)
+    if bundle is not None:
+        return [str(frequency) for frequency in bundle['frequency']]
     filePath = os.path.join('.', 'vibrationData', 'Select_Frequency.csv')
-    df = pd.read_csv(filePath,names = ['recipe','type','axis','frequency','mean','std'])
-    find = df.loc[df['recipe'] == recipe]
-    find = find.loc[find['axis'] == axis]
-    find = find.loc[find['type'] == datatype]
-    find = find.reset_index(drop=True)
-    if find.shape[0] == 1:
-        return find['frequency'][0].split(';') 
+    find = lookupSelectFrequency(filePath, recipe, datatype, axis)
+    if find is not None:
+        return find['frequency'].split(';') 
     else:
         return []
-def computeZscore(recipe,axis,datatype):
+def computeZscore(recipe,axis,datatype,oven=None):
+    bundle = findVibrationModel(recipe,axis,datatype,oven)
+    if bundle is not None and bundle['mean'] is not None:
+        return bundle['mean'],bundle['std']
     filePath = os.path.join('.', 'vibrationData', 'Select_Frequency.csv')
-    df = pd.read_csv(filePath,names = ['recipe','type', 'axis','frequency','mean','std'])
-    find = df.loc[df['recipe'] == recipe]
-    find = find.loc[find['axis'] == axis]
-    find = find.loc[find['type'] == datatype]
-    find = find.reset_index(drop=True)
-    if find.shape[0] == 1:
-        return find['mean'][0],find['std'][0]
+    find = lookupSelectFrequency(filePath, recipe, datatype, axis)
+    if find is not None:
+        return find['mean'],find['std']
     else:
         return 0,0
+def scoreFeatures(recipe,axis,datatype,oven,features):
+    """
+    anomaly of every column scored by the model of the run, nothing if there is no model
+    """
+    baseName = vibrationModelName(recipe, oven, axis, datatype)
+    bundle = loadVibrationModel(baseName)
+    if bundle is None or features.size == 0:
+        return {}
+    try:
+        anomaly, anomalyscore = scoreVibrationModel(bundle, features)
+    except Exception as e:
+        # the image does not depend on the model, vibration-anomaly-score.py reports the failure
+        print(e)
+        return {}
+    return {'model': vibrationModelSignature(baseName), 'anomaly': anomaly, 'anomalyscore': anomalyscore}
 def findVibrationFile(vibrationPath, startTime, endTime, sensorLabel):
     """
     find necessary vibration data paths list 
     """
     # find vibration data index
-    startTime = startTime[0:15] # 2019-05-02_1120
-    endTime   = endTime[0:15]
-    files = []
-    
-    # if the vibration data is cross day
-    if not(startTime[0:10] == endTime[0:10]) :
-        vibrationFileNameDay1 = startTime[0:10]
-        vibrationFileNameDay2 = endTime[0:10]
-        
-        vibrationFilePathDay1 = os.path.join('.',vibrationPath,vibrationFileNameDay1,'*'+sensorLabel+ '.csv')
-        vibrationFilePathDay2 = os.path.join('.',vibrationPath,vibrationFileNameDay2,'*'+sensorLabel + '.csv')
-        try:
-            filesDay1 = glob.glob(vibrationFilePathDay1)
-            filesDay1.sort()
-            startAppend = 0
-            for i, filename in enumerate(filesDay1):
-                if startTime in filename:
-                    startAppend = 1
-                if startAppend == 1:
-                    files.append(filename)
-            filesDay2 = glob.glob(vibrationFilePathDay2)
-            filesDay2.sort()
-            startAppend = 1
-
-            for i, filename in enumerate(filesDay2):
-                if endTime in filename:
-                    startAppend = 0
-                if startAppend == 1:
-                    files.append(filename)
-            
-        except Exception as e :
-            print(e)
-            sys.exit(1)
-    else:
-        vibrationFileName = startTime[0:10]
-        vibrationFilePath = os.path.join('.',vibrationPath,vibrationFileName,'*'+sensorLabel+ '.csv')
-        try:
-            files = glob.glob(vibrationFilePath)
-            files.sort()
-            start_index = 0
-            end_index = 0
-            for i, filename in enumerate(files):
-                if startTime in filename:
-                    start_index = i
-                elif endTime in filename:
-                    end_index = i
-            if len(files) == 0 or end_index <= start_index:
-                print('load ' + vibrationFilePath + ' fail!')
-                sys.exit(1)
-        except Exception as e :
-            print('load ' + vibrationFilePath + ' fail!')
-            sys.exit(1)
-        files = files[start_index:end_index]
+    startTime = datetime.datetime.strptime(startTime[0:15], vibrationTimeFormat) # 2019-05-02_1120
+    endTime   = datetime.datetime.strptime(endTime[0:15], vibrationTimeFormat)
+    try:
+        files = findVibrationFiles(os.path.join('.',vibrationPath), sensorLabel, startTime, endTime)
+    except Exception as e :
+        print(e)
+        sys.exit(1)
     
     if len(files) == 0:
         print('load fail!')
         sys.exit(1)
     return files
 
+def plotFigure(savePath, times, f, Sxx):
+    """
+    spectrogram figure with axes and color bar, drawn by pyplot
+    """
+    from matplotlib import pyplot as plt
+    plt.rcParams.update({'font.size': 20})
+    plt.rcParams['figure.figsize'] = (38, 18)
+    fig = plt.figure()
+    plt.pcolormesh(times, f, Sxx,vmax = 110)
+    plt.ylabel('Frequency [Hz]')
+    plt.xlabel('Time [sec]')
+    plt.colorbar()
+    plt.savefig(savePath,bbox_inches='tight')
+    plt.close(fig)
+
+def resample(Sxx, size, axis):
+    """
+    mean of the bins falling in each of size pixels, or the nearest bin if there are fewer bins than pixels
+    """
+    n = Sxx.shape[axis]
+    if n > size:
+        edges = np.linspace(0, n, size + 1).astype(int)[:-1]
+        counts = np.diff(np.append(edges, n))
+        shape = [1, 1]
+        shape[axis] = size
+        return np.add.reduceat(Sxx, edges, axis=axis) / counts.reshape(shape)
+    return np.take(Sxx, np.arange(size) * n // size, axis=axis)
+
+def renderImage(savePath, Sxx, width, height, vmax=110):
+    """
+    spectrogram image of width x height pixels, Sxx is averaged down to the pixel grid and
+    colormapped to uint8 as the figure does (vmin is the data minimum), no axes or color bar
+    """
+    from matplotlib import cm, image
+    Sxx = np.asarray(Sxx, dtype=np.float64)
+    # the scale of the figure, averaging would raise the minimum
+    vmin = min(float(Sxx.min()), vmax) if Sxx.size > 0 else 0
+    pixels = resample(resample(Sxx, height, 0), width, 1)
+    scaled = np.clip((pixels - vmin) / max(vmax - vmin, np.finfo(float).tiny), 0, 1)
+    name = matplotlib.rcParams['image.cmap']
+    colormap = matplotlib.colormaps[name] if hasattr(matplotlib, 'colormaps') else cm.get_cmap(name)
+    # low frequency at the bottom
+    rgba = colormap(scaled[::-1], bytes=True)
+    image.imsave(savePath, rgba)
+
 def main():
     start_index = 0
     end_index = 0
@@ -106,13 +125,12 @@ def main():
     endTime   =  sys.argv[5]
     receta    =  sys.argv[6]
     datatype  =  sys.argv[7] if len(sys.argv) > 7 else "fan"
-    vib_data  =  np.array([])
-    tmpList   =  []
-    tmpDict   =  {}
+    # "figure" draws the pyplot figure, "fast" writes the colormapped pixels only
+    renderMode =  sys.argv[8] if len(sys.argv) > 8 else "figure"
+    resolution =  sys.argv[9] if len(sys.argv) > 9 else "1900x900" # width x height of the fast image
     startTime_datetime = datetime.datetime.strptime(startTime, '%Y-%m-%d_%H%M%S')
     tmpType = "" if datatype == "fan" else datatype
-    saveFrequencyPath = os.path.join('.', 'data', sys.argv[2] + '/' + sys.argv[2] + '-' + sys.argv[3] + tmpType +'-SFFT.csv') #./data/OA20180910-101-F/OA20180910-101-F-X-SFFT.csv
-    saveSignalPath   = os.path.join('.', 'data',  sys.argv[2] + '/' + sys.argv[2] + '-' + sys.argv[3] + tmpType + '-Time.csv') #./data/OA20180910-101-F/OA20180910-101-F-X-Time.csv
+    saveFeaturePath = os.path.join('.', 'data', sys.argv[2] + '/' + sys.argv[2] + '-' + sys.argv[3] + tmpType + vibrationFeaturesSuffix) #./data/OA20180910-101-F/OA20180910-101-F-X-features.npz
 
     if sys.argv[2][:2] == 'OA':
         axis = '500401'
@@ -127,47 +145,34 @@ def main():
     
     fileGroup = findVibrationFile(sys.argv[1], startTime, endTime, axis)
     
-    for filename in fileGroup:
-        df = pd.read_csv(filename,names=['id','timestamp','X','Y','Z','index'])
-        vib_data = np.append(vib_data,df[Axis].values*1000)
-    
-    plt.rcParams.update({'font.size': 20})
-    plt.rcParams['figure.figsize'] = (38, 18)
-    f, t, Sxx = signal.spectrogram(vib_data, 1000,scaling = 'spectrum' , window = signal.get_window(('tukey',0.125),512),noverlap = 256)
+    f, t, Sxx = vibrationSpectrogram(fileGroup, Axis, 1000, nperseg=512, noverlap=256, cacheDir=os.path.join('.', sys.argv[1], spectrogramCacheName))
     
     vibrationTime = pd.DataFrame(t, columns=['timespan'])
-    for index, row in vibrationTime.iterrows():
-        tmpList.append(startTime_datetime + datetime.timedelta(0,0,row['timespan']*1000000))
-    vibrationTime[receta] = tmpList
-
-    tmpList = []
+    # start time + timespan rounded to microseconds
+    vibrationTime[receta] = np.datetime64(startTime_datetime, 'us') + np.round(t * 1000000).astype('int64').astype('timedelta64[us]')
     
     # plot figure
-    fig = plt.figure()
-    plt.pcolormesh(vibrationTime[receta], f, Sxx,vmax = 110)
-    plt.ylabel('Frequency [Hz]')
-    plt.xlabel('Time [sec]')
-    plt.colorbar()
     # check diretory exist
     if not os.path.isdir(savePath):
         os.mkdir(savePath)
     savePath = os.path.join(savePath, sys.argv[2] + '-SFFT-' + sys.argv[3] + ('-'+datatype if datatype != "fan" else "") +'.png')
-    plt.savefig(savePath,bbox_inches='tight')
-    
-    # save SFFT signal to csv file
-    frequency_selected = select_frequecy(receta,Axis,datatype)
-    mean,std     =  computeZscore(receta,Axis,datatype)
-
-    for frequency in frequency_selected:
-        tmpDict[frequency]  = Sxx[int(frequency),:]
+    if renderMode == "fast":
+        width, height = [int(size) for size in resolution.lower().split('x')]
+        renderImage(savePath, Sxx, width, height)
+    else:
+        plotFigure(savePath, vibrationTime[receta], f, Sxx)
     
-    feq_signal = pd.DataFrame(tmpDict)
-    tmpDict = {}
-
-    vibrationTime[str(mean)] = 0
-    vibrationTime[str(std)]  = 0
-    feq_signal.to_csv(saveFrequencyPath, sep=',')
-    vibrationTime.to_csv(saveSignalPath, sep=',')
+    # selected frequencies of the spectrogram, with the score of the model if there is one, for vibration-anomaly-score.py
+    frequency_selected = select_frequecy(receta,Axis,datatype,sys.argv[2][:2])
+    mean,std     =  computeZscore(receta,Axis,datatype,sys.argv[2][:2])
+    features     =  Sxx[[int(frequency) for frequency in frequency_selected],:].T
+    artifact = {
+        'recipe': receta, 'oven': sys.argv[2][:2], 'axis': Axis, 'type': datatype, 'start': startTime_datetime,
+        'mean': float(mean), 'std': float(std), 'frequency': [int(frequency) for frequency in frequency_selected],
+        'times': t, 'features': features
+    }
+    artifact.update(scoreFeatures(receta,Axis,datatype,sys.argv[2][:2],features))
+    saveVibrationFeatures(saveFeaturePath, artifact)
     print("generate SFFT figure successful!\n")
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -5,24 +5,13 @@ import time
 import os
 import datetime
 import json
-
-def curing_preprocessing(curing, columns):
-    curing_timestamp = [time.strftime( "%Y-%m-%d", time.strptime(fecha, "%d/%m/%Y"))+' '+hora for fecha,hora in zip(curing.Fecha, curing.Hora)]
-    
-    if not 'timestamp' in columns:
-        columns = ['timestamp'] + columns
-    
-    curing_n = curing.assign(timestamp=curing_timestamp)[ columns ]
-    
-    return curing_n
+from curingLib import readCuringFile
 
 def main():
     filepath = os.path.join('.', sys.argv[1], "Calc_" + sys.argv[1][5:19] + '.csv')
 
     try:
-        receta = pd.read_csv(filepath, encoding='ISO-8859-1', nrows=0).columns[1]
-        cur_pd = pd.read_csv(filepath, encoding='ISO-8859–1', skiprows=[0,1,2,4])
-        cur_pd = cur_pd.drop(columns=cur_pd.columns[-1], axis=1)
+        receta, cur_pd = readCuringFile(filepath)
 
         if cur_pd.shape[0] == 0:
             print('\n load ' + filepath + ' is nodata!')
@@ -38,8 +27,7 @@ def main():
         print('No model for ' + cur_pd.recipe)
         sys.exit(1)
     '''
-    cur_pd = curing_preprocessing(cur_pd, ['PMV', 'AMV'])
-    cur_pd['timestamp'] = pd.to_datetime(cur_pd['timestamp'])
+    cur_pd = cur_pd[['timestamp', 'PMV', 'AMV']]
     
     #start_time = cur_pd.loc[0,'timestamp'] + datetime.timedelta(hours=1)
     start_time = cur_pd.loc[0,'timestamp']
@@ -12,6 +12,9 @@ def preprocessing(di, t):
     xy_datas = {}
     for idx in di.index:
         curing = curing_datas[idx]
+        # a lazy dataset finds unusable runs on access
+        if curing is None:
+            continue
         
         if t.lower() == 'fan':
             current = current_fan_datas[idx]
@@ -57,7 +60,7 @@ def wrapZ(y_true, mean, std):
         std[std == 0] = tmpmin
     return np.mean(z_score(y_true, mean, std), axis=None)
 
-def getModel(x, y, t):
+def getModelCandidates(t, sparse=False, n_inducing=500):
     common_option = {
         'copy_X_train':True,
         'normalize_y':True
@@ -89,16 +92,15 @@ def getModel(x, y, t):
     __models = []
     
     for o in model_options:
-        __models.append(GaussianProcessRegressor(**{**o, **common_option}))
-    
-    __scores = []
-    for m in __models:
-        m.fit(x,y)
-        __scores.append(m.score(x, y))
-    
-    model = __models[np.argmax(__scores)]
+        if sparse:
+            __models.append(SparseGPRegressor(n_inducing=n_inducing, normalize_y=True, **o))
+        else:
+            __models.append(GaussianProcessRegressor(**{**o, **common_option}))
     
-    return model
+    return __models
+
+def getModel(x, y, t, sparse=False, n_inducing=500, jobs=1, seed=None):
+    return searchModels({'model': (x, y)}, getModelCandidates(t, sparse, n_inducing), jobs=jobs, seed=seed)['model']
 
 def __getPredict(x, y, model):
     mean, std = model.predict(x, return_std=True)
@@ -123,6 +125,7 @@ def getPredict(di, models, one_for_all=False):
 
 def algorithm1(di, one_for_all=False):
     models = {}
+    datasets = {}
     for autoclave in di.autoclave.unique():
         models[autoclave] = {}
         if one_for_all:
@@ -146,12 +149,17 @@ def algorithm1(di, one_for_all=False):
             x = np.concatenate(x, axis=0)
             y = np.concatenate(y, axis=0)
             print('Training', autoclave, recipe, ' : x size', x.shape, 'y size', y.shape)
-            models[autoclave][recipe] = getModel(x, y, data_type)
+            datasets[(autoclave, recipe)] = (x, y)
         if one_for_all:
             all_x = np.concatenate(all_x, axis=0)
             all_y = np.concatenate(all_y, axis=0)
             print('Training', autoclave, 'all recipe', ' : x size', all_x.shape, 'y size', all_y.shape)
-            models[autoclave]['all'] = getModel(all_x, all_y, data_type)
+            datasets[(autoclave, 'all')] = (all_x, all_y)
+    
+    # fit every (autoclave, recipe, candidate, restart) on the process pool
+    candidates = getModelCandidates(data_type, sparse=args.sparse, n_inducing=args.inducing)
+    for (autoclave, recipe), model in searchModels(datasets, candidates, jobs=args.jobs, seed=args.seed).items():
+        models[autoclave][recipe] = model
         
     return models
 
@@ -207,9 +215,17 @@ if __name__ == "__main__":
     args.add_argument('--model', type=str, required=False, help='Diretory for model, default is model', default='model')
     args.add_argument('--start', '-s', type=str, required=False, help='Curing date range for start dete')
     args.add_argument('--end', '-e', type=str, required=False, help='Curing date range for end dete')
+    args.add_argument('--jobs', '-j', type=int, required=False, help='Number of processes to load curing data and train models, default is 1', default=1)
+    args.add_argument('--seed', type=int, required=False, help='Random seed, set it for reproducible models')
+    args.add_argument('--lazy', action='store_true', help='Load curing data on access instead of keeping all of it in memory')
+    args.add_argument('--sparse', action='store_true', help='Train sparse GP on inducing points with all data')
+    args.add_argument('--inducing', type=int, required=False, help='Number of inducing points for --sparse, default is 500', default=500)
     
     args = args.parse_args()
     
+    if args.seed is not None:
+        np.random.seed(args.seed)
+    
     dataDir = args.data
     modelDir = args.model
     chooseAutoclave = args.oven
@@ -219,7 +235,8 @@ if __name__ == "__main__":
     data_type='fan'
     
     data_indexs, curing_datas, current_fan_datas, current_heater_datas \
-    = ToolDataset(dataDir, data_type, chooseAutoclave, chooseRecipe, startDate, endDate)
+    = ToolDataset(dataDir, data_type, chooseAutoclave, chooseRecipe, startDate, endDate,
+                  jobs=args.jobs, lazy=args.lazy, cacheSize=1)
     
     data_mask = data_indexs.autoclave != ""
     
@@ -237,6 +254,9 @@ if __name__ == "__main__":
     # preprocessing
     
     cc_datas, xy_datas = preprocessing(data_indexs, t=data_type)
+    data_indexs = data_indexs.loc[list(cc_datas.keys())]
+    if data_indexs.empty:
+        raise FileNotFoundError('No data can train model, check {} has data'.format(dataDir))
     
     models = loadModel(modelDir, data_type)
     
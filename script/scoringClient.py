@@ -0,0 +1,54 @@
+# thin client of scoringDaemon.py, only uses the standard library so it starts fast
+# usage: python3 scoringClient.py <script> [args...]
+# runs the script in the daemon if it is listening, otherwise runs it directly
+import os
+import sys
+import json
+import socket
+
+scriptDir = os.path.dirname(os.path.abspath(__file__))
+defaultSocket = '/tmp/nchc-scoring.sock'
+
+def runRemote(socketPath, script, args):
+    '''
+    @return  exit code(int), output(str), or None if the daemon is not available
+    '''
+    if not os.path.exists(socketPath):
+        return None
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(socketPath)
+    except OSError:
+        return None
+    try:
+        with sock:
+            request = {'script': script, 'args': args, 'cwd': os.getcwd()}
+            sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+            response = b''
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                response += data
+        response = json.loads(response.decode('utf-8'))
+        return response['code'], response['output']
+    except (OSError, ValueError, KeyError, TypeError):
+        # the daemon closed without a complete reply (crash, restart), run the script here
+        return None
+
+def main():
+    script, args = sys.argv[1], sys.argv[2:]
+    socketPath = os.environ.get('NCHCscoringSocket', defaultSocket)
+
+    result = runRemote(socketPath, script, args)
+    if result is None:
+        scriptPath = os.path.join(scriptDir, script)
+        os.execv(sys.executable, [sys.executable, scriptPath] + args)
+
+    code, output = result
+    sys.stdout.write(output)
+    sys.stdout.flush()
+    sys.exit(code)
+
+if __name__ == '__main__':
+    main()
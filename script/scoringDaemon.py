@@ -0,0 +1,134 @@
+# long-lived workers that run the analysis / scoring scripts in warm processes
+# usage: python3 scoringDaemon.py [socket path]
+# the scripts stay runnable on their own, scoringClient.py hands their arguments to this daemon
+import os
+import sys
+import io
+import json
+import runpy
+import signal
+import traceback
+import contextlib
+import socketserver
+
+scriptDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, scriptDir)
+
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib import pyplot as plt
+# heavy imports shared by the scripts, paid once
+import numpy as np
+import pandas as pd
+import scipy.signal
+import currentLib
+import vibrationLib
+
+defaultSocket = '/tmp/nchc-scoring.sock'
+defaultWorkers = 4
+scripts = [
+    'analysisFanCurrent.py',
+    'analysisHeaterCurrent.py',
+    'gen-SFFT-image.py',
+    'gen-vibration-time.py',
+    'vibration-anomaly-score.py'
+]
+
+def runScript(script, args, cwd):
+    '''
+    @param   script name, arguments, working directory of the caller
+    @return  exit code(int), combined stdout and stderr(str)
+    '''
+    if script not in scripts:
+        return 1, 'unknown script ' + script + '\n'
+
+    output = io.StringIO()
+    code = 0
+    argv = sys.argv
+    prev_cwd = os.getcwd()
+    try:
+        os.chdir(cwd)
+        sys.argv = [os.path.join(scriptDir, script)] + list(args)
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            try:
+                runpy.run_path(sys.argv[0], run_name='__main__')
+            except SystemExit as e:
+                if e.code is None:
+                    code = 0
+                elif isinstance(e.code, int):
+                    code = e.code
+                else:
+                    print(e.code, file=sys.stderr)
+                    code = 1
+            except Exception as e:
+                traceback.print_exc()
+                code = 1
+    finally:
+        sys.argv = argv
+        os.chdir(prev_cwd)
+        plt.close('all')
+    return code, output.getvalue()
+
+class ScoringHandler(socketserver.StreamRequestHandler):
+    # one json request per connection: {"script": ..., "args": [...], "cwd": ...}
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            code, output = runScript(request['script'], request.get('args', []), request.get('cwd', os.getcwd()))
+        except Exception as e:
+            code, output = 1, traceback.format_exc()
+        self.wfile.write((json.dumps({'code': code, 'output': output}) + '\n').encode('utf-8'))
+
+def serveWorker(server):
+    '''
+    @param   listening server shared by the workers
+    @return  never, the worker exits with the process
+    '''
+    # a stop of the daemon ends the worker, it must not look like an exit of the script
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    try:
+        server.serve_forever()
+    finally:
+        os._exit(0)
+
+def main():
+    socketPath = sys.argv[1] if len(sys.argv) > 1 else os.environ.get('NCHCscoringSocket', defaultSocket)
+    if os.path.exists(socketPath):
+        os.remove(socketPath)
+
+    # NCHCscoringWorkers long-lived workers accept on the same socket, each serves one request
+    # at a time and keeps the models and Select_Frequency tables it loaded for the next ones,
+    # requests run concurrently as when the Go server started the scripts itself, the rest wait
+    server = socketserver.UnixStreamServer(socketPath, ScoringHandler)
+    workers = {}
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            serveWorker(server)
+        workers[pid] = True
+
+    for i in range(max(int(os.environ.get('NCHCscoringWorkers', defaultWorkers)), 1)):
+        spawn()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print('scoring daemon listening on ' + socketPath + ' with ' + str(len(workers)) + ' workers')
+    sys.stdout.flush()
+    try:
+        while True:
+            # a worker that died (crash, killed) is replaced, its caches start cold
+            pid, status = os.wait()
+            if workers.pop(pid, None) is not None:
+                print('scoring worker ' + str(pid) + ' exited with ' + str(status) + ', restart')
+                sys.stdout.flush()
+                spawn()
+    finally:
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        server.server_close()
+        if os.path.exists(socketPath):
+            os.remove(socketPath)
+
+if __name__ == '__main__':
+    main()
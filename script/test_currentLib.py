@@ -0,0 +1,157 @@
+# equivalence of currentLib.current_preprocessing with the implementation it replaced
+# usage: cd script && python3 -m unittest test_currentLib
+import itertools
+import unittest
+import numpy as np
+import pandas as pd
+from currentLib import current_preprocessing
+
+def baseline_current_preprocessing(current, drop_duplicated=False, drop_zero=True, mean_size=0, mean_method='mean', drop_do_average=True):
+    # frozen copy of the duplicate ranking / per-addr merge implementation, do not change
+    current = current.copy()
+    if drop_zero:
+        current = current[current.value != 0]
+    # mark duplicated
+    dup_count = 0
+    cur = current
+    current_n = []
+    while True:
+        __tmp = cur[~cur.duplicated(keep='first', subset=['timestamp', 'addr'])]
+        current_n += [__tmp.assign(dup=dup_count)]
+        dup_count += 1
+        cur = cur[cur.duplicated(keep='first', subset=['timestamp', 'addr'])]
+
+        if cur.empty:
+            break
+
+    extra_columns = []
+    if drop_duplicated:
+        if drop_do_average:
+            __tmp = current_n[0]
+            for i in range(1, len(current_n)):
+                __tmp = __tmp.merge(current_n[i], how='left', on=['timestamp', 'addr'], suffixes=('', str(i)))
+            current_n = __tmp
+
+            all_values = current_n[current_n.columns.to_series().filter(like='value')].values
+            current_n = current_n.assign(
+                value=np.nanmean(all_values, axis=1),
+                var = np.nanvar(all_values, axis=1)
+            )
+            extra_columns = ['var']
+        else:
+            current_n = current_n[0]
+    else:
+        current_n = pd.concat(current_n)
+        current_n = current_n.sort_values(by=['timestamp', 'dup', 'addr'])
+
+    # tranpose addr
+    addrs = current_n.addr.unique()
+
+    if addrs.shape[0] == 0:
+        return pd.DataFrame()
+    __tmp = [current_n[current_n.addr == addr][
+        ['timestamp', 'dup', 'value'] + extra_columns
+    ].rename(
+        columns={s:s+'_'+str(addr) for s in ['value']+extra_columns}
+    ) for addr in addrs]
+
+    current_n = __tmp[0]
+    for i in range(1,len(__tmp)):
+        current_n = current_n.merge(__tmp[i], how='left', on=['timestamp', 'dup'])
+    current_n = current_n.fillna(method='ffill')
+
+    if mean_size > 0 and mean_size < current_n.shape[0]:
+        cols = ['value'] + extra_columns
+        cur = current_n[[s+'_'+str(addr) for s in cols for addr in addrs]].values
+
+        if mean_method and mean_method.lower() == "rms":
+            cur = cur ** 2
+
+        new_values = np.concatenate([np.convolve(cur[:,i], np.ones(mean_size)/mean_size,mode='vaild')[:,None] for i in range(cur.shape[1])], axis=1)
+
+        frontend = int((mean_size - 1) / 2)
+        backend = mean_size - 1 - frontend
+
+        cur[frontend:-backend, :] = new_values
+        new_values = cur
+
+        if mean_method and mean_method.lower() == "rms":
+            new_values = np.sqrt(new_values)
+
+        current_n = current_n.assign(**{s+'_'+str(addr):new_values[:, idx + i*len(cols)] for i, s in enumerate(cols) for idx, addr in enumerate(addrs)})
+
+    return current_n
+
+def make_current(seed, n=200, addrs=(0, 10, 20), max_dup=3, missing=0.1, zeros=0.05):
+    '''
+    current records of n timestamps, every (timestamp, addr) repeated up to max_dup times,
+    a fraction of them missing and a fraction of the values zero
+    '''
+    rng = np.random.RandomState(seed)
+    timestamps = pd.date_range('2019-05-02 10:00:00', periods=n, freq='S')
+    rows = []
+    for t in timestamps:
+        for addr in addrs:
+            if rng.rand() < missing:
+                continue
+            for k in range(rng.randint(1, max_dup + 1)):
+                rows.append((t, addr, 0.0 if rng.rand() < zeros else rng.normal(20, 3)))
+    df = pd.DataFrame(rows, columns=['timestamp', 'addr', 'value'])
+    # records arrive out of order
+    return df.iloc[rng.permutation(df.shape[0])].reset_index(drop=True)
+
+class TestCurrentPreprocessing(unittest.TestCase):
+    options = {
+        'drop_duplicated': [False, True],
+        'drop_zero': [False, True],
+        'drop_do_average': [False, True],
+        'mean_size': [0, 5, 60],
+        'mean_method': ['mean', 'rms'],
+    }
+
+    def assertSameFrame(self, expected, result, skip_columns=()):
+        self.assertEqual(list(expected.columns), list(result.columns))
+        columns = [col for col in expected.columns if col not in skip_columns]
+        pd.testing.assert_frame_equal(
+            expected[columns].reset_index(drop=True), result[columns].reset_index(drop=True),
+            check_dtype=False, check_exact=False, rtol=1e-9, atol=1e-9)
+
+    def check(self, current, **kwargs):
+        expected = baseline_current_preprocessing(current, **kwargs)
+        result = current_preprocessing(current, **kwargs)
+        # the baseline wrote the smoothed var columns to the wrong addr, fixed since
+        skip = [col for col in expected.columns if col.startswith('var_')] if kwargs.get('mean_size') else []
+        self.assertSameFrame(expected, result, skip)
+
+    def test_option_combinations(self):
+        current = make_current(0)
+        names = sorted(self.options)
+        for values in itertools.product(*[self.options[name] for name in names]):
+            kwargs = dict(zip(names, values))
+            with self.subTest(**kwargs):
+                self.check(current, **kwargs)
+
+    def test_multi_level_duplicates(self):
+        current = make_current(1, max_dup=6, missing=0.0)
+        for drop_duplicated in [False, True]:
+            with self.subTest(drop_duplicated=drop_duplicated):
+                self.check(current, drop_duplicated=drop_duplicated)
+
+    def test_missing_addrs(self):
+        # the first addr is missing at some timestamps, another one only shows up late
+        current = make_current(2, missing=0.4)
+        late = pd.DataFrame({'timestamp': pd.date_range('2019-05-02 10:02:00', periods=20, freq='S'), 'addr': 35, 'value': 1.5})
+        current = pd.concat([current, late], ignore_index=True)
+        for drop_duplicated in [False, True]:
+            with self.subTest(drop_duplicated=drop_duplicated):
+                self.check(current, drop_duplicated=drop_duplicated)
+                self.check(current, drop_duplicated=drop_duplicated, mean_size=5, mean_method='rms')
+
+    def test_all_zero(self):
+        current = make_current(3)
+        current['value'] = 0.0
+        self.assertTrue(current_preprocessing(current).empty)
+        self.assertTrue(baseline_current_preprocessing(current).empty)
+
+if __name__ == '__main__':
+    unittest.main()
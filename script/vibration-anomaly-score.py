@@ -2,20 +2,48 @@ import numpy as np
 import pandas as pd
 import sys
 import os
-from sklearn.externals import joblib
-from sklearn.decomposition import PCA
-def checkModelPath(modelList):
-    for modelPath in modelList:
-        if not os.path.exists(modelPath):
-            return False
-    return True
-def main():
-    OvenName    = sys.argv[1][0:2]
-    Axis        = sys.argv[2]
-    datatype    = sys.argv[4]
-    tmptype = "" if datatype == "fan" else datatype
-    SignalPath  = os.path.join('.', 'data', sys.argv[1] + '/' + sys.argv[1] + '-' + sys.argv[2] + tmptype + '-SFFT.csv')#./data/OA20180910-101-F/OA20180910-101-F-X-SFFT.csv
-    TimePath    = os.path.join('.', 'data', sys.argv[1] + '/' + sys.argv[1] + '-' + sys.argv[2] + tmptype + '-Time.csv')#./data/OA20180910-101-F/OA20180910-101-F-X-Time.csv
+from vibrationLib import loadVibrationModel, scoreVibrationModel, anomalyRate, vibrationModelName, vibrationModelSignature
+from vibrationLib import loadVibrationFeatures, vibrationFeaturesSuffix, lookupSelectFrequency
+
+def modelFrequency(bundle, SelectFrequencyPath, recipe, Axis, datatype):
+    """
+    frequency bins the model was trained on, older models keep them in Select_Frequency.csv, None if unknown
+    """
+    if bundle['frequency'] is not None:
+        return [int(frequency) for frequency in bundle['frequency']]
+    find = lookupSelectFrequency(SelectFrequencyPath, recipe, datatype, Axis) if os.path.isfile(SelectFrequencyPath) else None
+    if find is None:
+        return None
+    return [int(frequency) for frequency in str(find['frequency']).split(';')]
+
+def scoreFeatures(FeaturePath, SelectFrequencyPath, OvenName, Axis, datatype):
+    """
+    anomaly of every column and mean, std of the features written by gen-SFFT-image.py,
+    the score stored with them is used if the model did not change since, a retrained
+    model is only used on features of the frequencies it was trained on
+    """
+    artifact = loadVibrationFeatures(FeaturePath)
+    baseName = vibrationModelName(artifact['recipe'], OvenName, Axis, datatype)
+    signature = vibrationModelSignature(baseName)
+    if signature is None:
+        print('no vibration model of ' + baseName)
+        sys.exit(1)
+    if artifact['anomaly'] is not None and artifact['model'] == signature:
+        # mean and std were taken from the same model
+        return artifact['anomaly'], artifact['mean'], artifact['std']
+    bundle = loadVibrationModel(baseName)
+    frequency = modelFrequency(bundle, SelectFrequencyPath, artifact['recipe'], Axis, datatype)
+    if frequency is None or artifact['frequency'] is None or [int(f) for f in artifact['frequency']] != frequency:
+        raise ValueError(FeaturePath + ' was not taken at the frequencies of ' + baseName + ', regenerate SFFT features')
+    anomaly, anomalyscore = scoreVibrationModel(bundle, artifact['features'])
+    if bundle['mean'] is not None:
+        return anomaly, bundle['mean'], bundle['std']
+    return anomaly, artifact['mean'], artifact['std']
+
+def scoreCsv(SignalPath, TimePath, OvenName, Axis, datatype):
+    """
+    anomaly of every column and mean, std of the SFFT / Time csv written by older gen-SFFT-image.py
+    """
     try:
         SignalDataFrame         = pd.read_csv(SignalPath)
         SignalDataFrame         = SignalDataFrame.drop(SignalDataFrame.columns[0],axis=1)
@@ -25,44 +53,48 @@ def main():
         if datatype == "water" or datatype == "vacuum":
             baseName.insert(2, datatype)
         baseName = '-'.join(baseName)
-        isolation_modelPath     = os.path.join('.', 'model', baseName + '-ios.pkl')
-        first_scalarPath        = os.path.join('.', 'model', baseName + '-fst.pkl')
-        second_scalarPath       = os.path.join('.', 'model', baseName + '-sec.pkl')
-        
-        if not checkModelPath([isolation_modelPath,first_scalarPath,second_scalarPath]):
-            isolation_modelPath = os.path.join('.','default', 'model', baseName + '-ios.pkl')
-            first_scalarPath    = os.path.join('.','default', 'model', baseName + '-fst.pkl')
-            second_scalarPath   = os.path.join('.','default', 'model', baseName + '-sec.pkl')
-        isolation_model         = joblib.load(isolation_modelPath)
-        first_scalar            = joblib.load(first_scalarPath)
-        second_scalar           = joblib.load(second_scalarPath)
+        # ./model/<baseName>-bundle.pkl, else the legacy pickles, else the same under ./default/model
+        bundle = loadVibrationModel(baseName)
+        if bundle is None:
+            print('no vibration model of ' + baseName)
+            sys.exit(1)
     except Exception as e:
         print(e)
         sys.exit(1)
 
-    first_np_scaled = first_scalar.transform(SignalDataFrame)
-    data = pd.DataFrame(first_np_scaled)
-    
-    pca = PCA(n_components=2)
-    data = pca.fit_transform(data)
+    anomaly, anomalyscore = scoreVibrationModel(bundle, SignalDataFrame)
+    if bundle['mean'] is not None:
+        return anomaly, bundle['mean'], bundle['std']
+    return anomaly, TimeDataFrame.columns.values[3], TimeDataFrame.columns.values[4]
+
+def main():
+    OvenName    = sys.argv[1][0:2]
+    Axis        = sys.argv[2]
+    datatype    = sys.argv[4]
+    tmptype = "" if datatype == "fan" else datatype
+    FeaturePath = os.path.join('.', 'data', sys.argv[1] + '/' + sys.argv[1] + '-' + sys.argv[2] + tmptype + vibrationFeaturesSuffix)#./data/OA20180910-101-F/OA20180910-101-F-X-features.npz
+    SignalPath  = os.path.join('.', 'data', sys.argv[1] + '/' + sys.argv[1] + '-' + sys.argv[2] + tmptype + '-SFFT.csv')#./data/OA20180910-101-F/OA20180910-101-F-X-SFFT.csv
+    TimePath    = os.path.join('.', 'data', sys.argv[1] + '/' + sys.argv[1] + '-' + sys.argv[2] + tmptype + '-Time.csv')#./data/OA20180910-101-F/OA20180910-101-F-X-Time.csv
+    if os.path.isfile(FeaturePath):
+        try:
+            anomaly, mean, std = scoreFeatures(FeaturePath, sys.argv[3], OvenName, Axis, datatype)
+        except Exception as e:
+            print(e)
+            sys.exit(1)
+    else:
+        anomaly, mean, std = scoreCsv(SignalPath, TimePath, OvenName, Axis, datatype)
 
-    second_np_scaled = second_scalar.transform(data)
-    data = pd.DataFrame(second_np_scaled)
-    
-    TimeDataFrame['anomaly'] = isolation_model.predict(data)
-    TimeDataFrame['anomaly'] = TimeDataFrame['anomaly'].map( {1: 0, -1: 1} )
-    anomaly_number = TimeDataFrame['anomaly'].value_counts()
-    TimeDataFrame['anomalyscore'] = isolation_model.score_samples(data)
-    
+    anomalous = int(np.sum(anomaly))
     try:
-        anomaly_rate = anomaly_number[1] / anomaly_number[0]
-        mean         = float(TimeDataFrame.columns.values[3])
-        std          = float(TimeDataFrame.columns.values[4])
-        anomaly_score   = (anomaly_rate - mean) / std
+        # a run without anomalous or without normal columns has no rate, it scores 0
+        if anomalous == 0 or anomalous == len(anomaly):
+            raise ValueError('no anomaly rate')
+        anomaly_rate    = anomalyRate(anomaly)
+        anomaly_score   = (anomaly_rate - float(mean)) / float(std)
     except:
         anomaly_score = 0
-    
+
 
     print(anomaly_score)
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
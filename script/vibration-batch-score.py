@@ -0,0 +1,185 @@
+import os
+import sys
+import argparse
+import logging
+import datetime
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from curingLib import findCuringFiles
+from vibrationLib import vibrationAxes, vibrationModelName, vibrationSensorCode, loadVibrationModel, lookupSelectFrequency
+from vibrationLib import findVibrationFiles, vibrationSpectrograms, spectrogramCacheName, scoreVibrationModel, anomalyRate
+
+# scores many curing runs of an oven in one process, the models are loaded once
+# and the spectrograms stay in memory, one row per run and axis goes to --output
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s [%(levelname)-5.5s]  %(message)s",
+    handlers=[logging.StreamHandler()])
+
+logger              = logging.getLogger()
+curingPath          = 'curingData'
+vibrationPath       = 'vibrationData'
+selectFrequencyPath = os.path.join(vibrationPath, 'Select_Frequency.csv')
+outputColumns       = ['name', 'recipe', 'axis', 'start', 'end', 'files', 'columns', 'anomalies', 'anomaly_rate', 'zscore', 'status']
+# the first and the last hour of a run are heating and cooling, as in vibrationTool.py
+runMargin           = datetime.timedelta(hours=1)
+
+'''
+@param
+@return  parser(object)
+'''
+def processCommand():
+    parser = argparse.ArgumentParser(description='score the vibration of many curing runs in one process')
+    parser.add_argument('--oven', '-ov', type=str, required=True, choices=['OA', 'OB', 'OC'], help='Name for oven')
+    parser.add_argument('--axis', '-as', type=str, default='all', choices=['X', 'Y', 'Z', 'all'], help='Name for axis, all for X, Y and Z')
+    parser.add_argument('--type', '-ty', type=str, default='fan', choices=['fan', 'water', 'vacuum'], help='Name for type')
+    parser.add_argument('--recipe', '-re', type=str, default=None, help='only runs of this recipe')
+    parser.add_argument('--runs', type=str, nargs='*', default=None, help='curing runs, e.g. OA20190502-001 or Calc_OA20190502-001.csv')
+    parser.add_argument('--from', dest='startDate', type=str, default=None, help='first day of the runs (YYYYMMDD)')
+    parser.add_argument('--to', dest='endDate', type=str, default=None, help='last day of the runs (YYYYMMDD)')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='worker processes')
+    parser.add_argument('--cache', action='store_true', help='keep the spectrograms in ' + spectrogramCacheName + ' for later runs')
+    parser.add_argument('--output', '-o', type=str, default='-', help='csv of the scores, - for stdout')
+    return parser.parse_args()
+
+'''
+@param   curing file name or run name
+@return  run name, e.g. OA20190502-001
+'''
+def runName(filename):
+    name = os.path.basename(filename)
+    if name.startswith('Calc_'):
+        name = name[len('Calc_'):]
+    if name.endswith('.csv'):
+        name = name[:-len('.csv')]
+    return name
+
+'''
+@param   oven, recipe filter, run names, first and last day
+@return  index of the curing runs to score (DataFrame)
+'''
+def findRuns(oven, recipe, runs, startDate, endDate):
+    index = findCuringFiles(os.path.join('.', curingPath), 'Calc_' + oven + '*', autoclave=oven, recipe=recipe, startDate=startDate, endDate=endDate)
+    if runs is not None:
+        index = index[index.filename.map(runName).isin(set(runName(run) for run in runs))]
+    return index.reset_index(drop=True)
+
+# models of the worker by (recipe, axis), set once per process by setBatchOptions
+batchOptions = None
+batchModels = {}
+
+def setBatchOptions(options):
+    global batchOptions
+    batchOptions = options
+    batchModels.clear()
+
+'''
+@param   recipe, oven, axis, type
+@return  bundle with its frequency, mean and std, or None if there is no model
+'''
+def batchModel(recipe, oven, axis, datatype):
+    key = (recipe, axis)
+    if key not in batchModels:
+        bundle = loadVibrationModel(vibrationModelName(recipe, oven, axis, datatype))
+        if bundle is not None and (bundle['frequency'] is None or bundle['mean'] is None):
+            # older models keep the frequencies and the z-score in Select_Frequency.csv
+            find = lookupSelectFrequency(selectFrequencyPath, recipe, datatype, axis)
+            if find is None and bundle['frequency'] is None:
+                bundle = None
+            elif find is not None:
+                bundle = dict(bundle)
+                if bundle['frequency'] is None:
+                    bundle['frequency'] = [int(frequency) for frequency in str(find['frequency']).split(';')]
+                if bundle['mean'] is None:
+                    bundle['mean'], bundle['std'] = float(find['mean']), float(find['std'])
+        batchModels[key] = bundle
+    return batchModels[key]
+
+'''
+@param   curing run (dict of the curing index)
+@return  rows of the score of every axis (list of dict)
+'''
+def scoreRun(run):
+    oven, axes, datatype, cache = batchOptions
+    name, recipe = runName(run['filename']), run['recipe']
+    start = pd.Timestamp(run['start']).to_pydatetime() + runMargin
+    end = pd.Timestamp(run['end']).to_pydatetime() - runMargin
+    rows = [dict(name=name, recipe=recipe, axis=axis, start=start, end=end, files=0, columns=0, anomalies=0) for axis in axes]
+
+    bundles = {axis: batchModel(recipe, oven, axis, datatype) for axis in axes}
+    for row in rows:
+        if bundles[row['axis']] is None:
+            row['status'] = 'no model'
+    axes = [axis for axis in axes if bundles[axis] is not None]
+    if len(axes) == 0:
+        return rows
+
+    try:
+        files = findVibrationFiles(os.path.join('.', vibrationPath), vibrationSensorCode(oven, datatype), start, end) if start < end else []
+        if len(files) == 0:
+            for row in rows:
+                row.setdefault('status', 'no vibration file')
+            return rows
+        spectrograms = vibrationSpectrograms(files, axes, 1000, nperseg=512, noverlap=0,
+            bins={axis: bundles[axis]['frequency'] for axis in axes},
+            cacheDir=os.path.join('.', vibrationPath, spectrogramCacheName) if cache else None)
+    except Exception as e:
+        logger.warning(name + ' load vibration fail! ' + str(e))
+        for row in rows:
+            row.setdefault('status', 'load fail')
+        return rows
+
+    for row in rows:
+        axis = row['axis']
+        if axis not in spectrograms:
+            continue
+        bundle = bundles[axis]
+        f, t, Sxx = spectrograms[axis]
+        anomaly, score = scoreVibrationModel(bundle, Sxx.T)
+        rate = anomalyRate(anomaly)
+        row.update(files=len(files), columns=int(anomaly.shape[0]), anomalies=int(anomaly.sum()), anomaly_rate=rate, status='ok')
+        if bundle['mean'] is not None and bundle['std']:
+            row['zscore'] = (rate - float(bundle['mean'])) / float(bundle['std'])
+    logger.info(name + ' scored')
+    return rows
+
+def scoreRunWorker(run):
+    try:
+        return scoreRun(run)
+    except Exception as e:
+        logger.warning(runName(run['filename']) + ' score fail! ' + str(e))
+        return [dict(name=runName(run['filename']), recipe=run['recipe'], axis=axis, files=0, columns=0, anomalies=0, status='fail') for axis in batchOptions[1]]
+
+def main():
+    args = processCommand()
+    for path in [curingPath, vibrationPath]:
+        if not os.path.isdir(os.path.join('.', path)):
+            logger.error(path + ' directory not exist')
+            sys.exit(1)
+
+    runs = findRuns(args.oven, args.recipe, args.runs, args.startDate, args.endDate)
+    if runs.shape[0] == 0:
+        logger.error('no curing run match')
+        sys.exit(1)
+    logger.info(str(runs.shape[0]) + ' curing runs to score')
+
+    options = (args.oven, vibrationAxes if args.axis == 'all' else [args.axis], args.type, args.cache)
+    runs = runs.to_dict('records')
+    if args.jobs > 1 and len(runs) > 1:
+        # results come back in the order of the runs
+        executor = ProcessPoolExecutor(max_workers=args.jobs, initializer=setBatchOptions, initargs=(options,))
+        results = executor.map(scoreRunWorker, runs)
+    else:
+        executor = None
+        setBatchOptions(options)
+        results = (scoreRunWorker(run) for run in runs)
+    try:
+        table = pd.DataFrame([row for rows in results for row in rows], columns=outputColumns)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    table.to_csv(sys.stdout if args.output == '-' else args.output, index=False)
+
+if __name__ == '__main__':
+    main()
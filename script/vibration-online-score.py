@@ -0,0 +1,145 @@
+import os
+import sys
+import time
+import datetime
+import argparse
+import logging
+from vibrationLib import vibrationModelName, loadVibrationModel, findVibrationFiles, vibrationFileTime, readVibrationFile
+from vibrationLib import vibrationSensorCode, OnlineVibrationScorer
+
+# scores the vibration of a curing run while it is running, minute file by minute file
+# every update appends one csv row to --output:
+# time,file,columns,anomalies,window_rate,window_zscore,run_rate,run_zscore,latency_ms
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s [%(levelname)-5.5s]  %(message)s",
+    handlers=[logging.StreamHandler()])
+
+logger         = logging.getLogger()
+vibrationPath  = 'vibrationData'
+outputColumns  = ['time', 'file', 'columns', 'anomalies', 'window_rate', 'window_zscore', 'run_rate', 'run_zscore', 'latency_ms']
+timeFormat     = '%Y-%m-%d %H:%M'
+
+'''
+@param
+@return  parser(object)
+'''
+def processCommand():
+    parser = argparse.ArgumentParser(description='score the vibration of a running curing online')
+    parser.add_argument('--oven', '-ov', type=str, required=True, choices=['OA', 'OB', 'OC'], help='Name for oven')
+    parser.add_argument('--recipe', '-re', type=str, required=True, help='Name for recipe')
+    parser.add_argument('--axis', '-as', type=str, required=True, choices=['X', 'Y', 'Z'], help='Name for axis')
+    parser.add_argument('--type', '-ty', type=str, default='fan', choices=['fan', 'water', 'vacuum'], help='Name for type')
+    parser.add_argument('--start', type=str, default=None, help='first minute of the run (YYYY-MM-DD HH:MM), now by default')
+    parser.add_argument('--end', type=str, default=None, help='stop after this minute (YYYY-MM-DD HH:MM), run until --idle by default')
+    parser.add_argument('--window', type=int, default=600, help='spectrogram columns of the sliding anomaly rate')
+    parser.add_argument('--poll', type=float, default=10, help='seconds between looks for new files')
+    parser.add_argument('--settle', type=float, default=5, help='seconds a file is left unchanged before it is read')
+    parser.add_argument('--idle', type=float, default=0, help='stop after this many seconds without a new file, 0 never')
+    parser.add_argument('--output', '-o', type=str, default='-', help='csv to append the updates to, - for stdout')
+    parser.add_argument('--path', '-p', type=str, default=vibrationPath, help='vibration data path')
+    return parser.parse_args()
+
+'''
+@param   vibration data file, files after it (list), time (float)
+@return  True if the file is completely written
+'''
+def isSettled(filename, later, settle, now):
+    # a newer minute file means the sensor moved on, archived files have no csv left
+    if len(later) > 0 or not os.path.isfile(filename):
+        return True
+    return now - os.path.getmtime(filename) >= settle
+
+def formatValue(value):
+    return '' if value is None else repr(float(value))
+
+def main():
+    args = processCommand()
+    if not os.path.isdir(args.path):
+        logger.error(args.path + ' directory not exist')
+        sys.exit(1)
+    try:
+        startTime = datetime.datetime.strptime(args.start, timeFormat) if args.start else datetime.datetime.now()
+        endTime = datetime.datetime.strptime(args.end, timeFormat) if args.end else None
+    except ValueError as e:
+        logger.error('time argument error ' + str(e))
+        sys.exit(1)
+
+    baseName = vibrationModelName(args.recipe, args.oven, args.axis, args.type)
+    bundle = loadVibrationModel(baseName)
+    if bundle is None:
+        logger.error('no vibration model of ' + baseName)
+        sys.exit(1)
+    try:
+        scorer = OnlineVibrationScorer(bundle, window=args.window)
+    except ValueError as e:
+        logger.error(baseName + ': ' + str(e))
+        sys.exit(1)
+
+    code = vibrationSensorCode(args.oven, args.type)
+    if args.output == '-':
+        output = sys.stdout
+    else:
+        output = open(args.output, 'a')
+    if output is sys.stdout or output.tell() == 0:
+        output.write(','.join(outputColumns) + '\n')
+        output.flush()
+
+    # start minute of the next file to read, and the start of the signal the scorer continues
+    nextTime = startTime.replace(second=0, microsecond=0)
+    signalStart = None
+    lastUpdate = time.time()
+    try:
+        while endTime is None or nextTime <= endTime:
+            now = time.time()
+            searchEnd = datetime.datetime.now() + datetime.timedelta(minutes=2)
+            if endTime is not None:
+                searchEnd = min(searchEnd, endTime + datetime.timedelta(minutes=1))
+            files = findVibrationFiles(args.path, code, nextTime, searchEnd)
+            for i, filename in enumerate(files):
+                if not isSettled(filename, files[i + 1:], args.settle, now):
+                    break
+                begin = time.perf_counter()
+                fileTime = vibrationFileTime(filename)
+                if signalStart is None or fileTime != nextTime:
+                    # first file, or minutes are missing, the spectrogram does not continue over the gap
+                    if signalStart is not None:
+                        logger.warning('no vibration file from ' + nextTime.strftime(timeFormat) + ' to ' + fileTime.strftime(timeFormat))
+                    scorer.reset()
+                    signalStart = fileTime
+                try:
+                    t, anomaly, score = scorer.update(readVibrationFile(filename, args.axis) * 1000)
+                except Exception as e:
+                    # the minute is lost, the next file starts a new signal as after a gap
+                    logger.warning('load ' + filename + ' fail! ' + str(e))
+                    scorer.reset()
+                    signalStart = None
+                    t, anomaly = [], []
+                nextTime = fileTime + datetime.timedelta(minutes=1)
+                lastUpdate = time.time()
+                if len(t) == 0:
+                    continue
+                windowRate, runRate = scorer.windowRate(), scorer.runRate()
+                row = [
+                    (signalStart + datetime.timedelta(seconds=float(t[-1]))).strftime('%Y-%m-%d %H:%M:%S'),
+                    os.path.basename(filename), str(len(anomaly)), str(int(anomaly.sum())),
+                    formatValue(windowRate), formatValue(scorer.zscore(windowRate)),
+                    formatValue(runRate), formatValue(scorer.zscore(runRate)),
+                    '{:.1f}'.format((time.perf_counter() - begin) * 1000)
+                ]
+                output.write(','.join(row) + '\n')
+                output.flush()
+            if endTime is not None and nextTime > endTime:
+                break
+            if args.idle > 0 and time.time() - lastUpdate >= args.idle:
+                logger.info('no new vibration file for ' + str(args.idle) + ' seconds, stop')
+                break
+            time.sleep(args.poll)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,968 @@
+import os
+import re
+import glob
+import json
+import bisect
+import hashlib
+import fcntl
+import shutil
+import datetime
+import contextlib
+import collections
+import numpy as np
+import pandas as pd
+from scipy import signal
+from sklearn.externals import joblib
+from sklearn.decomposition import PCA
+
+selectFrequencyColumns = ['recipe', 'type', 'axis', 'frequency', 'mean', 'std']
+vibrationColumns = ['id', 'timestamp', 'X', 'Y', 'Z', 'index']
+vibrationAxes = ['X', 'Y', 'Z']
+# every vibration file covers one minute, the start minute is in its name, e.g. 2019-05-02_1120
+vibrationTimeFormat = '%Y-%m-%d_%H%M'
+vibrationTimePattern = re.compile(r'\d{4}-\d{2}-\d{2}_\d{4}')
+# samples of every axis read at a time for the spectrograms, whatever the length of the files
+vibrationBlockSize = 65536
+# compacted vibration data of a day and sensor, <vibrationPath>/<YYYY-MM-DD>/<sensorCode>.archive/<version>/
+# {X,Y,Z}.npy hold the samples of all files back to back, index.npy where each file starts,
+# the file current names the version to read and is swapped by os.replace
+vibrationArchiveSuffix = '.archive'
+vibrationArchivePointer = 'current'
+# csv files written to within the last seconds are left out of the archive, the sensor may still append
+vibrationSettleSeconds = 60
+# start minute of the vibration files of a day per sensor, <vibrationPath>/<YYYY-MM-DD>/.vibrationCatalog.json
+vibrationCatalogName = '.vibrationCatalog.json'
+# trained scoring pipeline of a (recipe, oven, type, axis), <modelDir>/<baseName>-bundle.pkl
+vibrationModelDirs = [os.path.join('.', 'model'), os.path.join('.', 'default', 'model')]
+vibrationBundleSuffix = '-bundle.pkl'
+vibrationLegacySuffixes = ['-fst.pkl', '-sec.pkl', '-ios.pkl']
+# spectrograms of vibration files, <vibrationPath>/.spectrogramCache/<sha1 of files, parameters and bins>.npz,
+# the least recently used ones are removed past spectrogramCacheBytes
+spectrogramCacheName = '.spectrogramCache'
+spectrogramCacheBytes = 2 * 1024 ** 3
+# spectrogram features of a run for scoring, data/<run>/<run>-<axis><type>-features.npz, fields and dtypes
+vibrationFeaturesSuffix = '-features.npz'
+vibrationFeaturesFields = {
+    'recipe': 'U', 'oven': 'U', 'axis': 'U', 'type': 'U', 'start': 'M8[us]', 'mean': 'f8', 'std': 'f8',
+    'frequency': 'i8', 'times': 'f8', 'features': 'f8',
+    'model': 'U', 'anomaly': 'i1', 'anomalyscore': 'f8'
+}
+# sensor of every oven, OB also has the vacuum pump and the cooling water
+vibrationSensorCodes = {('OA', 'fan'): '500401', ('OB', 'fan'): '500402', ('OC', 'fan'): '500403',
+    ('OB', 'vacuum'): '500404', ('OB', 'water'): '500405'}
+vibrationArchiveIndexDtype = np.dtype([
+    ('name', 'U64'), ('time', 'M8[m]'), ('offset', 'i8'), ('count', 'i8'), ('mtime', 'i8'), ('size', 'i8')
+])
+
+# loaded files by path, reloaded when mtime changes, so a long-lived process keeps them warm
+__fileCache = {}
+
+def __cached(path, load):
+    # a file swapped in by os.replace is a new inode even within the mtime resolution
+    stat = os.stat(path)
+    mtime = (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+    key = (os.path.abspath(path), load)
+    if key in __fileCache and __fileCache[key][0] == mtime:
+        return __fileCache[key][1]
+    data = load(path)
+    __fileCache[key] = (mtime, data)
+    return data
+
+def __readSelectFrequency(path):
+    return pd.read_csv(path, names=selectFrequencyColumns, float_precision='round_trip')
+
+def __indexSelectFrequency(path):
+    # first row of every (recipe, type, axis)
+    index = {}
+    for row in readSelectFrequency(path).itertuples(index=False):
+        index.setdefault((row.recipe, row.type, row.axis), row._asdict())
+    return index
+
+def loadPickle(path):
+    '''
+    @param   path of a joblib pickle (model, scaler)
+    @return  the object, cached in process
+    '''
+    return __cached(path, joblib.load)
+
+def readSelectFrequency(path):
+    '''
+    @param   path of Select_Frequency.csv
+    @return  Select_Frequency table (DataFrame), cached in process
+    '''
+    return __cached(path, __readSelectFrequency)
+
+def lookupSelectFrequency(path, recipe, datatype, axis):
+    '''
+    @param   path of Select_Frequency.csv, recipe, type, axis
+    @return  row of the key (dict of recipe, type, axis, frequency, mean, std), or None
+
+    The table is parsed and indexed once per version of the file.
+    '''
+    if not os.path.isfile(path):
+        return None
+    return __cached(path, __indexSelectFrequency).get((recipe, datatype, axis))
+
+@contextlib.contextmanager
+def __locked(path):
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def upsertSelectFrequency(path, recipe, datatype, axis, frequency, mean, std):
+    '''
+    @param   path of Select_Frequency.csv, recipe, type, axis, frequencies ('a;b;c;d'), mean, std
+    @return
+
+    Writers hold <path>.lock, so parallel trainings do not lose each
+    other's rows, and the new table is swapped in by rename, so readers
+    never see a half written file. Duplicated rows of the key collapse
+    into the updated one.
+    '''
+    with __locked(path):
+        if os.path.isfile(path):
+            df = __readSelectFrequency(path)
+        else:
+            df = pd.DataFrame(columns=selectFrequencyColumns)
+        row = [recipe, datatype, axis, frequency, str(mean), str(std)]
+        match = np.nonzero(((df['recipe'] == recipe) & (df['type'] == datatype) & (df['axis'] == axis)).values)[0]
+        if match.shape[0] == 0:
+            df = pd.concat([df, pd.DataFrame([row], columns=selectFrequencyColumns)], ignore_index=True)
+        else:
+            df = df.astype(object)
+            df.iloc[match[0]] = row
+            df = df.drop(df.index[match[1:]])
+        tmpPath = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            df.to_csv(tmpPath, header=False, index=False, sep=',')
+            os.replace(tmpPath, path)
+        finally:
+            if os.path.isfile(tmpPath):
+                os.remove(tmpPath)
+
+def vibrationFileTime(filename):
+    '''
+    @param   vibration data file
+    @return  start minute in the file name (datetime), or None
+    '''
+    result = vibrationTimePattern.search(os.path.basename(filename))
+    if result is None:
+        return None
+    return datetime.datetime.strptime(result.group(0), vibrationTimeFormat)
+
+def archivePath(dayDir, sensorCode):
+    return os.path.join(dayDir, sensorCode + vibrationArchiveSuffix)
+
+def __loadArchive(indexPath):
+    archiveDir = os.path.dirname(indexPath)
+    index = np.load(indexPath, allow_pickle=False)
+    return {
+        'index': index,
+        'files': {str(name): (int(offset), int(count)) for name, offset, count in zip(index['name'], index['offset'], index['count'])},
+        'stat': {str(name): (int(mtime), int(size)) for name, mtime, size in zip(index['name'], index['mtime'], index['size'])},
+        # memory mapped, a slice of a file does not copy or read the rest of the day
+        'samples': {axis: np.load(os.path.join(archiveDir, axis + '.npy'), mmap_mode='r') for axis in vibrationAxes}
+    }
+
+def __readPointer(pointerPath):
+    with open(pointerPath, 'r', encoding='utf-8') as f:
+        return f.read().strip()
+
+def __archiveVersion(archiveDir):
+    # version directory the archive reads, None for an archive written before the versions
+    pointerPath = os.path.join(archiveDir, vibrationArchivePointer)
+    if not os.path.isfile(pointerPath):
+        return None
+    return __cached(pointerPath, __readPointer)
+
+# index of the archive version last read by directory, the memory maps of older versions are released
+__archiveIndexes = {}
+
+def readArchive(dayDir, sensorCode):
+    '''
+    @param   directory of a day, sensor code
+    @return  archive of the day (dict of index, files, samples), or None if not compacted
+    '''
+    archiveDir = archivePath(dayDir, sensorCode)
+    version = __archiveVersion(archiveDir)
+    indexPath = os.path.join(archiveDir, 'index.npy') if version is None else os.path.join(archiveDir, version, 'index.npy')
+    if not os.path.isfile(indexPath):
+        return None
+    indexPath = os.path.abspath(indexPath)
+    previous = __archiveIndexes.get(archiveDir)
+    if previous is not None and previous != indexPath:
+        __fileCache.pop((previous, __loadArchive), None)
+    __archiveIndexes[archiveDir] = indexPath
+    return __cached(indexPath, __loadArchive)
+
+def __listArchives(dayDir):
+    return [name[:-len(vibrationArchiveSuffix)] for name in os.listdir(dayDir) if name.endswith(vibrationArchiveSuffix)]
+
+def __archivedFile(filename):
+    dayDir = os.path.dirname(filename) or '.'
+    if not os.path.isdir(dayDir):
+        return None, None
+    name = os.path.basename(filename)
+    for sensorCode in __cached(dayDir, __listArchives):
+        if name.endswith(sensorCode + '.csv'):
+            archive = readArchive(dayDir, sensorCode)
+            if archive is None or name not in archive['files']:
+                continue
+            # a csv changed since it was archived is read from the csv until the next compaction
+            try:
+                stat = os.stat(filename)
+            except FileNotFoundError:
+                return archive, archive['files'][name]
+            if (stat.st_mtime_ns, stat.st_size) != archive['stat'][name]:
+                return None, None
+            return archive, archive['files'][name]
+    return None, None
+
+def listVibrationFiles(dayDir, sensorCode):
+    '''
+    @param   directory of a day, sensor code
+    @return  sorted vibration data files of the sensor, archived ones included even if the csv is removed
+    '''
+    names = set(os.path.basename(filename) for filename in glob.glob(os.path.join(dayDir, '*' + sensorCode + '.csv')))
+    archive = readArchive(dayDir, sensorCode)
+    if archive is not None:
+        names.update(archive['files'].keys())
+    return [os.path.join(dayDir, name) for name in sorted(names)]
+
+def vibrationModelName(recipe, oven, axis, datatype='fan'):
+    '''
+    @param   recipe, oven name, axis, type of sensor ('fan', 'water' or 'vacuum')
+    @return  base name of the vibration model, e.g. <recipe>-OB-water-X
+    '''
+    baseName = [recipe, oven, axis]
+    if datatype != 'fan':
+        baseName.insert(2, datatype)
+    return '-'.join(baseName)
+
+def vibrationSensorCode(oven, datatype='fan'):
+    '''
+    @param   oven name, type of sensor ('fan', 'water' or 'vacuum')
+    @return  sensor code in the vibration file names, the fan of the oven for other pairs
+    '''
+    return vibrationSensorCodes.get((oven, datatype), vibrationSensorCodes[(oven, 'fan')])
+
+def saveVibrationModel(modelDir, baseName, bundle):
+    '''
+    @param   model directory, base name, bundle (dict of first_scaler, pca, second_scaler, isolation_model, frequency, mean, std)
+    @return  path of the bundle
+    '''
+    bundlePath = os.path.join(modelDir, baseName + vibrationBundleSuffix)
+    tmpPath = '{}.{}.tmp'.format(bundlePath, os.getpid())
+    joblib.dump(bundle, tmpPath)
+    os.replace(tmpPath, bundlePath)
+    return bundlePath
+
+def __vibrationModelFiles(baseName, modelDirs):
+    for modelDir in (vibrationModelDirs if modelDirs is None else modelDirs):
+        bundlePath = os.path.join(modelDir, baseName + vibrationBundleSuffix)
+        if os.path.isfile(bundlePath):
+            return [bundlePath]
+        legacy = [os.path.join(modelDir, baseName + suffix) for suffix in vibrationLegacySuffixes]
+        if all(os.path.isfile(path) for path in legacy):
+            return legacy
+    return None
+
+def loadVibrationModel(baseName, modelDirs=None):
+    '''
+    @param   base name, model directories in order of preference
+    @return  bundle (dict), or None if no model is found
+
+    Models trained before the bundle existed are the three -fst/-sec/-ios
+    pickles, they come back as a bundle whose pca, frequency, mean and std
+    are None.
+    '''
+    files = __vibrationModelFiles(baseName, modelDirs)
+    if files is None:
+        return None
+    if len(files) == 1:
+        return loadPickle(files[0])
+    first_scaler, second_scaler, isolation_model = [loadPickle(path) for path in files]
+    return {
+        'first_scaler': first_scaler, 'pca': None, 'second_scaler': second_scaler,
+        'isolation_model': isolation_model, 'frequency': None, 'mean': None, 'std': None
+    }
+
+def vibrationModelSignature(baseName, modelDirs=None):
+    '''
+    @param   base name, model directories in order of preference
+    @return  paths and mtimes of the model loadVibrationModel picks (str), or None if no model is found
+    '''
+    files = __vibrationModelFiles(baseName, modelDirs)
+    if files is None:
+        return None
+    return ';'.join('{}:{}'.format(os.path.abspath(path), os.stat(path).st_mtime_ns) for path in files)
+
+def saveVibrationFeatures(path, artifact):
+    '''
+    @param   path of the .npz, artifact (dict of vibrationFeaturesFields, None for a missing field)
+    @return
+
+    recipe, oven, axis, type and start describe the run, mean and std are the
+    z-score of its model, frequency are the selected bins, times (seconds
+    from start) and features (time x frequency) the spectrogram columns of
+    those bins. model, anomaly and anomalyscore are the score of the
+    features if a model was there, model is its vibrationModelSignature.
+    '''
+    arrays = {}
+    for name, value in artifact.items():
+        if name not in vibrationFeaturesFields:
+            raise KeyError('unknown vibration feature field ' + name)
+        if value is not None:
+            arrays[name] = np.asarray(value, dtype=vibrationFeaturesFields[name])
+    tmpPath = '{}.{}.tmp.npz'.format(path[:-len('.npz')] if path.endswith('.npz') else path, os.getpid())
+    try:
+        np.savez(tmpPath, **arrays)
+        os.replace(tmpPath, path)
+    finally:
+        if os.path.isfile(tmpPath):
+            os.remove(tmpPath)
+
+def loadVibrationFeatures(path):
+    '''
+    @param   path of the .npz written by saveVibrationFeatures
+    @return  artifact (dict of every vibrationFeaturesFields, None if missing), scalars as str / float / np.datetime64
+    '''
+    artifact = dict.fromkeys(vibrationFeaturesFields)
+    with np.load(path, allow_pickle=False) as data:
+        for name in data.files:
+            value = data[name]
+            if value.ndim == 0:
+                value = str(value) if value.dtype.kind == 'U' else value[()]
+                if isinstance(value, np.floating):
+                    value = float(value)
+            artifact[name] = value
+    return artifact
+
+def scoreVibrationModel(bundle, features):
+    '''
+    @param   bundle, spectrogram of the selected frequencies (time x frequency)
+    @return  anomaly (np.ndarray of 0 / 1), anomaly score (np.ndarray)
+    '''
+    # columns are positional, the names differ between training and the SFFT csv
+    data = bundle['first_scaler'].transform(np.asarray(features))
+    if bundle['pca'] is not None:
+        data = bundle['pca'].transform(data)
+    else:
+        # legacy model without a fitted PCA
+        data = PCA(n_components=2).fit_transform(data)
+    data = bundle['second_scaler'].transform(data)
+    anomaly = (bundle['isolation_model'].predict(data) == -1).astype(int)
+    return anomaly, bundle['isolation_model'].score_samples(data)
+
+def anomalyRate(anomaly):
+    '''
+    @param   anomaly (0 / 1) of every spectrogram column
+    @return  anomalous / normal columns, 0 if there is none of either
+    '''
+    anomalous = int(np.sum(anomaly))
+    normal = len(anomaly) - anomalous
+    if anomalous == 0 or normal == 0:
+        return 0
+    return anomalous / normal
+
+def readVibrationAxes(filename, axes):
+    '''
+    @param   vibration data file, list of axis ('X', 'Y' or 'Z')
+    @return  samples of every axis (dict of np.ndarray) from one parse, only those columns are parsed
+
+    Archived files are a float32 view of the memory mapped archive.
+    '''
+    archive, location = __archivedFile(filename)
+    if archive is not None:
+        offset, count = location
+        return {axis: archive['samples'][axis][offset:offset + count] for axis in axes}
+    df = pd.read_csv(filename, names=vibrationColumns, usecols=axes, dtype={axis: np.float64 for axis in axes})
+    return {axis: df[axis].values for axis in axes}
+
+def readVibrationFile(filename, axis):
+    '''
+    @param   vibration data file, axis ('X', 'Y' or 'Z')
+    @return  samples of the axis (np.ndarray)
+    '''
+    return readVibrationAxes(filename, [axis])[axis]
+
+def iterVibration(files, axes, blockSize, scale=1000):
+    '''
+    @param   list of vibration data file, list of axis, samples per block, scale of the samples
+    @return  generator of blocks of blockSize samples * scale of every axis (dict of np.ndarray), the last one may be shorter
+
+    Every file is parsed once for all the axes, blocks run across the file boundaries.
+    '''
+    block = {axis: np.empty(blockSize) for axis in axes}
+    n = 0
+    for filename in files:
+        values = readVibrationAxes(filename, axes)
+        length = len(values[axes[0]])
+        i = 0
+        while i < length:
+            take = min(blockSize - n, length - i)
+            for axis in axes:
+                block[axis][n:n + take] = values[axis][i:i + take]
+            n += take
+            i += take
+            if n == blockSize:
+                for axis in axes:
+                    block[axis] *= scale
+                yield block
+                block = {axis: np.empty(blockSize) for axis in axes}
+                n = 0
+    if n > 0:
+        for axis in axes:
+            block[axis] = block[axis][:n]
+            block[axis] *= scale
+        yield block
+
+def __readCatalog(catalogPath):
+    try:
+        with open(catalogPath, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except ValueError:
+        # empty or being rewritten
+        return {}
+
+def __catalogEntry(dayDir, sensorCode):
+    entries = []
+    for filename in listVibrationFiles(dayDir, sensorCode):
+        fileTime = vibrationFileTime(filename)
+        if fileTime is not None:
+            entries.append((int((fileTime - datetime.datetime(1970, 1, 1)).total_seconds() // 60), os.path.basename(filename)))
+    entries.sort()
+    return {'minutes': [m for m, name in entries], 'names': [name for m, name in entries]}
+
+def __updateCatalog(dayDir, sensorCode):
+    # the catalog is rewritten in place, only its creation changes the mtime of the day directory it is checked against
+    catalogPath = os.path.join(dayDir, vibrationCatalogName)
+    with __locked(catalogPath):
+        with open(catalogPath, 'a', encoding='utf-8'):
+            pass
+        mtime = os.stat(dayDir).st_mtime_ns
+        catalog = __readCatalog(catalogPath)
+        entry = catalog.get(sensorCode)
+        if entry is None or entry['mtime'] != mtime:
+            entry = dict(mtime=mtime, **__catalogEntry(dayDir, sensorCode))
+            catalog[sensorCode] = entry
+            with open(catalogPath, 'r+', encoding='utf-8') as f:
+                f.truncate()
+                json.dump(catalog, f)
+        return entry
+
+def __dayCatalogEntry(dayDir, sensorCode):
+    catalogPath = os.path.join(dayDir, vibrationCatalogName)
+    if os.path.isfile(catalogPath):
+        entry = __cached(catalogPath, __readCatalog).get(sensorCode)
+        if entry is not None and entry['mtime'] == os.stat(dayDir).st_mtime_ns:
+            return entry
+    try:
+        return __updateCatalog(dayDir, sensorCode)
+    except OSError:
+        # read-only data directory, the catalog is only an optimization
+        return __catalogEntry(dayDir, sensorCode)
+
+def findVibrationFiles(vibrationPath, sensorCode, startTime, endTime):
+    '''
+    @param   vibration data path, sensor code, start and end time (datetime)
+    @return  sorted vibration data files of the sensor start in [startTime, endTime), over any number of days
+
+    The start minutes are parsed from the file names once per day directory
+    and kept in <day>/.vibrationCatalog.json, a lookup reads the catalogs of
+    the days it covers only, and a day is scanned again only when its
+    directory changes.
+    '''
+    startTime = startTime.replace(second=0, microsecond=0)
+    endTime = endTime.replace(second=0, microsecond=0)
+    epoch = datetime.datetime(1970, 1, 1)
+    start = int((startTime - epoch).total_seconds() // 60)
+    end = int((endTime - epoch).total_seconds() // 60)
+
+    files = []
+    day = startTime.date()
+    while day <= endTime.date():
+        dayDir = os.path.join(vibrationPath, day.strftime('%Y-%m-%d'))
+        day += datetime.timedelta(days=1)
+        if not os.path.isdir(dayDir):
+            continue
+        entry = __dayCatalogEntry(dayDir, sensorCode)
+        lo = bisect.bisect_left(entry['minutes'], start)
+        hi = bisect.bisect_left(entry['minutes'], end)
+        files.extend(os.path.join(dayDir, name) for name in entry['names'][lo:hi])
+    return files
+
+def compactVibrationDay(dayDir, sensorCode, removeSource=False, settle=vibrationSettleSeconds):
+    '''
+    @param   directory of a day, sensor code, remove the csv files after compaction or not,
+             seconds a csv is left unchanged before it is archived
+    @return  archived or not (bool), False when the archive is already up to date
+
+    The new archive is written to a version directory of its own and the
+    pointer file is swapped to it, readers see the old or the new archive but
+    never a missing one, and a failed compaction leaves the old one in place.
+    '''
+    targetPath = archivePath(dayDir, sensorCode)
+    if not os.path.isdir(targetPath) and len(glob.glob(os.path.join(dayDir, '*' + sensorCode + '.csv'))) == 0:
+        return False
+    with __locked(targetPath):
+        return __compactVibrationDay(dayDir, sensorCode, targetPath, removeSource, settle)
+
+def __compactVibrationDay(dayDir, sensorCode, targetPath, removeSource, settle):
+    now = datetime.datetime.now().timestamp()
+    files = []
+    for filename in listVibrationFiles(dayDir, sensorCode):
+        # a file still being written is archived by a later compaction
+        if os.path.isfile(filename) and now - os.path.getmtime(filename) < settle:
+            continue
+        files.append(filename)
+    archive = readArchive(dayDir, sensorCode)
+    archived = {} if archive is None else {str(entry['name']): entry for entry in archive['index']}
+
+    # up to date when every csv is archived with the same mtime and size
+    stale = False
+    for filename in files:
+        name = os.path.basename(filename)
+        if not os.path.isfile(filename):
+            continue
+        stat = os.stat(filename)
+        if name not in archived or archived[name]['mtime'] != stat.st_mtime_ns or archived[name]['size'] != stat.st_size:
+            stale = True
+            break
+    if not stale:
+        if removeSource:
+            for filename in files:
+                if os.path.isfile(filename):
+                    os.remove(filename)
+        return False
+
+    index = np.zeros(len(files), dtype=vibrationArchiveIndexDtype)
+    samples = {axis: [] for axis in vibrationAxes}
+    offset = 0
+    for i, filename in enumerate(files):
+        name = os.path.basename(filename)
+        if os.path.isfile(filename):
+            stat = os.stat(filename)
+            df = pd.read_csv(filename, names=vibrationColumns, usecols=vibrationAxes, dtype={axis: np.float64 for axis in vibrationAxes})
+            values = {axis: df[axis].values for axis in vibrationAxes}
+            mtime, size = stat.st_mtime_ns, stat.st_size
+        else:
+            # the csv was removed by an earlier compaction
+            start, count = archive['files'][name]
+            values = {axis: archive['samples'][axis][start:start + count] for axis in vibrationAxes}
+            mtime, size = archived[name]['mtime'], archived[name]['size']
+        count = len(values[vibrationAxes[0]])
+        fileTime = vibrationFileTime(name)
+        index[i] = (name, np.datetime64(fileTime, 'm') if fileTime is not None else np.datetime64('NaT'), offset, count, mtime, size)
+        for axis in vibrationAxes:
+            samples[axis].append(np.asarray(values[axis], dtype=np.float32))
+        offset += count
+
+    previous = __archiveVersion(targetPath)
+    version = 'v{}-{}'.format(datetime.datetime.now().strftime('%Y%m%d%H%M%S%f'), os.getpid())
+    versionPath = os.path.join(targetPath, version)
+    pointerPath = os.path.join(targetPath, vibrationArchivePointer)
+    tmpPath = '{}.{}.tmp'.format(pointerPath, os.getpid())
+    try:
+        os.makedirs(versionPath)
+        for axis in vibrationAxes:
+            data = np.concatenate(samples[axis]) if len(samples[axis]) > 0 else np.array([], dtype=np.float32)
+            np.save(os.path.join(versionPath, axis + '.npy'), data)
+        np.save(os.path.join(versionPath, 'index.npy'), index)
+        with open(tmpPath, 'w', encoding='utf-8') as f:
+            f.write(version)
+        os.replace(tmpPath, pointerPath)
+    except BaseException:
+        shutil.rmtree(versionPath, ignore_errors=True)
+        raise
+    finally:
+        if os.path.isfile(tmpPath):
+            os.remove(tmpPath)
+
+    # the previous version stays for readers that read the pointer just before the swap,
+    # readers holding an older memory map keep their copy
+    for name in os.listdir(targetPath):
+        if name in (vibrationArchivePointer, version, previous) or (previous is None and name.endswith('.npy')):
+            continue
+        path = os.path.join(targetPath, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.isfile(path):
+            os.remove(path)
+
+    if removeSource:
+        for filename in files:
+            if os.path.isfile(filename):
+                os.remove(filename)
+    return True
+
+class StreamingSpectrogram(object):
+    '''
+    Spectrogram of a signal fed block by block, the columns equal
+    signal.spectrogram(x, fs, window=window, nperseg=nperseg, noverlap=noverlap, scaling='spectrum')
+    of the whole signal. The samples of an unfinished segment are carried to
+    the next block, and only the bins asked for are kept.
+    '''
+    def __init__(self, fs=1000, nperseg=512, noverlap=0, window=('tukey', 0.125), bins=None):
+        self.fs = fs
+        self.nperseg = nperseg
+        self.step = nperseg - noverlap
+        self.window = signal.get_window(window, nperseg)
+        self.bins = None if bins is None else np.asarray(bins, dtype=int)
+        self.f = np.fft.rfftfreq(nperseg, 1.0 / fs)
+        # 'spectrum' scaling, and the one-sided spectrum doubles every bin but DC (and Nyquist)
+        self.scale = np.full(self.f.shape[0], 2.0 / self.window.sum() ** 2)
+        self.scale[0] /= 2
+        if nperseg % 2 == 0:
+            self.scale[-1] /= 2
+        if self.bins is not None:
+            self.f = self.f[self.bins]
+            self.scale = self.scale[self.bins]
+        self.__carry = np.array([])
+        self.__start = 0
+        self.__times = []
+        self.__columns = []
+
+    def update(self, block):
+        '''
+        @param   next samples of the signal
+        @return  times (np.ndarray), columns (np.ndarray, bins x segments) of the segments completed by the block
+        '''
+        data = np.concatenate([self.__carry, block])
+        count = (data.shape[0] - self.nperseg) // self.step + 1 if data.shape[0] >= self.nperseg else 0
+        if count == 0:
+            self.__carry = data
+            return np.array([]), np.empty((self.f.shape[0], 0))
+        segments = np.lib.stride_tricks.as_strided(data, shape=(count, self.nperseg), strides=(self.step * data.strides[0], data.strides[0]))
+        segments = (segments - segments.mean(axis=1, keepdims=True)) * self.window
+        spectrum = np.fft.rfft(segments, axis=1)
+        if self.bins is not None:
+            spectrum = spectrum[:, self.bins]
+        Sxx = (spectrum.real ** 2 + spectrum.imag ** 2) * self.scale
+        t = (self.__start + self.nperseg / 2 + self.step * np.arange(count)) / self.fs
+        self.__carry = data[count * self.step:].copy()
+        self.__start += count * self.step
+        return t, Sxx.T
+
+    def feed(self, block):
+        '''
+        @param   next samples of the signal, the columns are kept for result()
+        '''
+        t, Sxx = self.update(block)
+        if t.shape[0] > 0:
+            self.__times.append(t)
+            self.__columns.append(Sxx)
+
+    def result(self):
+        '''
+        @return  frequencies, times, Sxx (np.ndarray) of all the blocks fed, as signal.spectrogram
+        '''
+        if len(self.__times) == 0:
+            return self.f, np.array([]), np.empty((self.f.shape[0], 0))
+        return self.f, np.concatenate(self.__times), np.concatenate(self.__columns, axis=1)
+
+    def compute(self, blocks):
+        '''
+        @param   iterable of sample blocks
+        @return  frequencies, times, Sxx (np.ndarray) of all the blocks, as signal.spectrogram
+        '''
+        for block in blocks:
+            self.feed(block)
+        return self.result()
+
+class OnlineVibrationScorer(object):
+    '''
+    Scores the spectrogram columns of a signal fed block by block with a
+    vibration model, and keeps the anomaly rate of the last `window` columns
+    and of the whole run. Only the unfinished segment and the window are held,
+    so memory does not grow with the length of the run.
+    '''
+    def __init__(self, bundle, window=600, fs=1000, nperseg=512, noverlap=0):
+        if bundle['pca'] is None or bundle['frequency'] is None:
+            raise ValueError('vibration model has no fitted pca or frequency, train it again with vibrationTool.py')
+        self.bundle = bundle
+        self.fs = fs
+        self.nperseg = nperseg
+        self.noverlap = noverlap
+        self.window = collections.deque(maxlen=window)
+        self.windowAnomalous = 0
+        self.columns = 0
+        self.anomalous = 0
+        self.reset()
+
+    def reset(self):
+        '''
+        drop the unfinished segment, the next block does not continue the signal (e.g. a missing minute)
+        '''
+        self.spectrogram = StreamingSpectrogram(self.fs, self.nperseg, self.noverlap, bins=self.bundle['frequency'])
+
+    def update(self, block):
+        '''
+        @param   next samples of the signal
+        @return  times since the last reset, anomaly (0 / 1), anomaly score (np.ndarray) of the columns completed by the block
+        '''
+        t, Sxx = self.spectrogram.update(block)
+        if t.shape[0] == 0:
+            return t, np.array([], dtype=int), np.array([])
+        anomaly, score = scoreVibrationModel(self.bundle, Sxx.T)
+        for value in anomaly:
+            if len(self.window) == self.window.maxlen:
+                self.windowAnomalous -= self.window[0]
+            self.window.append(int(value))
+            self.windowAnomalous += int(value)
+        self.columns += anomaly.shape[0]
+        self.anomalous += int(anomaly.sum())
+        return t, anomaly, score
+
+    def windowRate(self):
+        '''
+        @return  anomalous / normal columns of the window, as anomalyRate
+        '''
+        return self.__rate(self.windowAnomalous, len(self.window))
+
+    def runRate(self):
+        '''
+        @return  anomalous / normal columns since the start, as anomalyRate
+        '''
+        return self.__rate(self.anomalous, self.columns)
+
+    def zscore(self, rate):
+        '''
+        @param   anomaly rate
+        @return  z-score of the rate with the mean and std of the model, or None if the model has none
+        '''
+        if self.bundle.get('mean') is None or not self.bundle.get('std'):
+            return None
+        return (rate - float(self.bundle['mean'])) / float(self.bundle['std'])
+
+    @staticmethod
+    def __rate(anomalous, count):
+        normal = count - anomalous
+        if anomalous == 0 or normal == 0:
+            return 0
+        return anomalous / normal
+
+def __fileSignature(filename):
+    # an archived file keeps the mtime and size of its csv, so compaction does not invalidate the cache
+    archive, location = __archivedFile(filename)
+    if archive is not None:
+        return archive['stat'][os.path.basename(filename)]
+    stat = os.stat(filename)
+    return stat.st_mtime_ns, stat.st_size
+
+def __spectrogramKey(files, axis, fs, nperseg, noverlap, bins):
+    bins = None if bins is None else [int(b) for b in bins]
+    key = hashlib.sha1(json.dumps([axis, fs, 'tukey', 0.125, nperseg, noverlap, bins]).encode('utf-8'))
+    for filename in files:
+        mtime, size = __fileSignature(filename)
+        key.update('{}:{}:{}\n'.format(os.path.basename(filename), mtime, size).encode('utf-8'))
+    return key.hexdigest()
+
+def __loadSpectrogram(cachePath):
+    try:
+        with np.load(cachePath, allow_pickle=False) as cache:
+            result = cache['f'], cache['t'], cache['Sxx']
+        # the access time orders the pruning, noatime and relatime mounts do not keep it
+        os.utime(cachePath)
+        return result
+    except Exception as e:
+        return None
+
+def __pruneSpectrograms(cacheDir, maxBytes):
+    entries = []
+    for name in os.listdir(cacheDir):
+        if not name.endswith('.npz') or name.endswith('.tmp.npz'):
+            continue
+        try:
+            stat = os.stat(os.path.join(cacheDir, name))
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_atime, stat.st_size, name))
+    total = sum(size for atime, size, name in entries)
+    for atime, size, name in sorted(entries):
+        if total <= maxBytes:
+            break
+        try:
+            os.remove(os.path.join(cacheDir, name))
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def __saveSpectrogram(cachePath, f, t, Sxx, maxBytes):
+    tmpPath = '{}.{}.tmp.npz'.format(cachePath[:-4], os.getpid())
+    try:
+        os.makedirs(os.path.dirname(cachePath), exist_ok=True)
+        np.savez(tmpPath, f=f, t=t, Sxx=Sxx)
+        os.replace(tmpPath, cachePath)
+        __pruneSpectrograms(os.path.dirname(cachePath), maxBytes)
+    except Exception as e:
+        # read-only data directory, the cache is only an optimization
+        if os.path.isfile(tmpPath):
+            os.remove(tmpPath)
+
+def vibrationSpectrograms(files, axes, fs=1000, nperseg=512, noverlap=0, bins=None, cacheDir=None, scale=1000, cacheBytes=spectrogramCacheBytes):
+    '''
+    @param   list of vibration data file, list of axis, spectrogram parameters, frequency bins to keep of
+             each axis (dict, an axis not in it keeps all), cache directory, scale of the samples,
+             size limit of the cache directory in bytes
+    @return  {axis: (frequencies, times, Sxx)}, every file is parsed once for all the axes
+
+    With a cache directory the float32 Sxx of the kept bins of each axis is
+    stored under a key of the files (name, mtime, size), the axis, the
+    spectrogram parameters and the bins. Only the axes missing from the cache
+    are computed.
+    '''
+    bins = {} if bins is None else bins
+    results = {}
+    cachePaths = {}
+    if cacheDir is not None:
+        for axis in axes:
+            cachePaths[axis] = os.path.join(cacheDir, __spectrogramKey(files, axis, fs, nperseg, noverlap, bins.get(axis)) + '.npz')
+            cached = __loadSpectrogram(cachePaths[axis]) if os.path.isfile(cachePaths[axis]) else None
+            if cached is not None:
+                results[axis] = cached
+    missing = [axis for axis in axes if axis not in results]
+
+    if len(missing) > 0:
+        spectrograms = {
+            axis: StreamingSpectrogram(fs=fs, nperseg=nperseg, noverlap=noverlap, bins=bins.get(axis))
+            for axis in missing
+        }
+        for block in iterVibration(files, missing, vibrationBlockSize, scale):
+            for axis in missing:
+                spectrograms[axis].feed(block[axis])
+        for axis in missing:
+            f, t, Sxx = spectrograms[axis].result()
+            if cacheDir is not None:
+                Sxx = Sxx.astype(np.float32)
+                __saveSpectrogram(cachePaths[axis], f, t, Sxx, cacheBytes)
+            results[axis] = f, t, Sxx
+    return results
+
+def vibrationSpectrogram(files, axis, fs=1000, nperseg=512, noverlap=0, bins=None, cacheDir=None):
+    '''
+    @param   list of vibration data file, axis, spectrogram parameters, frequency bins to keep, cache directory
+    @return  frequencies, times, Sxx (np.ndarray) without holding the whole signal in memory
+    '''
+    return vibrationSpectrograms(files, [axis], fs, nperseg, noverlap, bins={axis: bins}, cacheDir=cacheDir)[axis]
+
+def __ricker(points, a):
+    # same wavelet as signal.ricker, which newer scipy no longer ships
+    A = 2 / (np.sqrt(3 * a) * (np.pi ** 0.25))
+    vec = np.arange(0, points) - (points - 1.0) / 2
+    xsq = vec ** 2
+    return A * (1 - xsq / a ** 2) * np.exp(-xsq / (2 * a ** 2))
+
+def __relativeMaxima(matr):
+    # strict local maxima along the frequency axis (axis 1), as signal.argrelmax
+    mask = np.zeros(matr.shape, dtype=bool)
+    mask[:, 1:-1] = (matr[:, 1:-1] > matr[:, :-2]) & (matr[:, 1:-1] > matr[:, 2:])
+    return mask
+
+def __convolveSame(matr, kernel):
+    # np.convolve(column, kernel, mode='same') of every column, one shifted add per tap
+    n = matr.shape[0]
+    center = (kernel.shape[0] - 1) // 2
+    out = np.zeros(matr.shape)
+    for k, weight in enumerate(kernel):
+        shift = center - k
+        if shift >= 0:
+            out[:n - shift] += weight * matr[shift:]
+        else:
+            out[-shift:] += weight * matr[:n + shift]
+    return out
+
+def __noiseFloor(row, noisePerc=10):
+    # percentile of the finest scale in a window of ceil(n/20) bins around every bin
+    n = row.shape[0]
+    window = int(np.ceil(n / 20.0))
+    half, odd = divmod(window, 2)
+    noise = np.empty(row.shape)
+    interior = np.arange(half, n - half - odd + 1)
+    if interior.shape[0] > 0:
+        windows = np.lib.stride_tricks.sliding_window_view(row, window, axis=0)
+        noise[interior] = np.percentile(windows[interior - half], noisePerc, axis=-1)
+    for i in np.setdiff1d(np.arange(n), interior):
+        noise[i] = np.percentile(row[max(i - half, 0):min(i + half + odd, n)], noisePerc, axis=0)
+    return noise
+
+def __ridgePeaks(Sxx, widths):
+    # peaks of every column at once, see peakFrequencyVotes
+    n = Sxx.shape[0]
+    cwt = np.empty((len(widths),) + Sxx.shape)
+    for i, width in enumerate(widths):
+        wavelet = __ricker(min(10 * width, n), width)
+        cwt[i] = __convolveSame(Sxx, wavelet)
+    maxima = __relativeMaxima(cwt)
+    tolerance = np.floor(np.asarray(widths) / 4.0).astype(int)
+    minLength = int(np.ceil(len(widths) / 4.0))
+
+    # a ridge starts at a maximum that no maximum of the scale below (or the one
+    # below that, a scale may be skipped once) continues, and is followed up
+    # to the nearest maximum within the tolerance of its current scale
+    start = np.zeros(maxima.shape, dtype=bool)
+    start[0] = maxima[0]
+    for r in range(1, len(widths)):
+        continued = np.zeros(maxima.shape[1:], dtype=bool)
+        for below in range(max(r - 2, 0), r):
+            reach = maxima[below].copy()
+            for distance in range(1, tolerance[below] + 1):
+                reach[distance:] |= maxima[below, :-distance]
+                reach[:-distance] |= maxima[below, distance:]
+            continued |= reach
+        start[r] = maxima[r] & ~continued
+    srow, freq, col = np.nonzero(start)
+    pos = freq.copy()
+    row = srow.copy()
+    length = np.ones(freq.shape[0], dtype=int)
+    for target in range(1, len(widths)):
+        active = np.nonzero((row == target - 1) | (row == target - 2))[0]
+        found = np.zeros(active.shape[0], dtype=bool)
+        for distance in range(0, tolerance.max() + 1):
+            for offset in ([0] if distance == 0 else [-distance, distance]):
+                candidate = pos[active] + offset
+                hit = ~found & (distance <= tolerance[row[active]]) & (candidate >= 0) & (candidate < n)
+                hit[hit] = maxima[target, candidate[hit], col[active][hit]]
+                pos[active[hit]] = candidate[hit]
+                found |= hit
+        row[active[found]] = target
+        length[active[found]] += 1
+
+    # signal to noise ratio on the finest scale
+    noise = __noiseFloor(cwt[0])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        snr = np.abs(cwt[srow, freq, col] / noise[freq, col])
+    keep = (length >= minLength) & (snr >= 1)
+    peaks = np.zeros(Sxx.shape, dtype=bool)
+    peaks[freq[keep], col[keep]] = True
+    return peaks
+
+def peakFrequencyVotes(Sxx, widths=np.arange(1, 10), maxColumns=10000, method='fast', blockSize=2000):
+    '''
+    @param   spectrogram (frequency x time), wavelet widths, columns to vote (None for all), 'fast' or 'cwt', columns per block
+    @return  number of columns each frequency bin is a peak of (np.ndarray)
+
+    'cwt' runs signal.find_peaks_cwt on every column. 'fast' does the same
+    steps (ricker wavelet transform, relative maxima, ridge lines, SNR >= 1
+    over the 10th percentile noise of the finest scale) on a block of columns
+    at once, but follows the ridges up instead of down: a ridge starts at
+    every maximum that no maximum of the one or two scales below continues,
+    on any scale, and is kept if it is long enough. Its peak is the bin it
+    starts at and its SNR is taken on that scale. The votes differ from 'cwt'
+    on a few percent of the peaks, mostly between neighbouring bins, and
+    rarely change the top frequencies.
+    '''
+    columns = Sxx.shape[1] if maxColumns is None else min(maxColumns, Sxx.shape[1])
+    votes = np.zeros(Sxx.shape[0], dtype=int)
+    if method == 'cwt':
+        for column in Sxx[:, :columns].T:
+            peakind = signal.find_peaks_cwt(column, widths)
+            votes[peakind] = votes[peakind] + 1
+        return votes
+    for start in range(0, columns, blockSize):
+        block = np.asarray(Sxx[:, start:min(start + blockSize, columns)], dtype=np.float64)
+        votes += __ridgePeaks(block, widths).sum(axis=1)
+    return votes
@@ -3,15 +3,14 @@ import numpy as np
 import argparse
 import logging
 import os
-import glob
-import time
 import datetime
-from scipy import signal
-from scipy.signal import argrelextrema
+from concurrent.futures import ProcessPoolExecutor
 from sklearn.ensemble import IsolationForest
 from sklearn import preprocessing
 from sklearn.decomposition import PCA
-from sklearn.externals import joblib
+from curingLib import readCuringFile, findCuringFiles
+from vibrationLib import findVibrationFiles, vibrationSpectrogram, vibrationSpectrograms, vibrationAxes, spectrogramCacheName, peakFrequencyVotes
+from vibrationLib import vibrationModelName, saveVibrationModel, scoreVibrationModel, anomalyRate, upsertSelectFrequency
 
 # Constant
 logging.basicConfig(
@@ -29,6 +28,7 @@ anomalyRatePath     = 'anomalyRate'
 modelPath           = 'model'
 selectFrequencyPath = 'vibrationData'
 selectFrequencyName = 'Select_Frequency.csv'
+spectrogramCachePath = os.path.join('.', vibrationPath, spectrogramCacheName)
 sensorLabel         = {'OA' : '500401' , 'OB' : '500402' , 'OC' : '500403' }
 outliers_fraction   = 0.01
 
@@ -42,8 +42,11 @@ def processCommand():
     parser = argparse.ArgumentParser()
     parser.add_argument('--oven','-ov',type=str, required=True, help = 'Name for oven')
     parser.add_argument('--recipe', '-re', type=str, required=True, help='Name for recipe')
-    parser.add_argument('--axis', '-as', type=str, required=True, help='Name for axis')
+    parser.add_argument('--axis', '-as', type=str, required=True, help='Name for axis, all for X, Y and Z in one pass')
     parser.add_argument('--type', '-ty', type=str, required=False, default="fan", help='Name for type')
+    parser.add_argument('--peak-method', type=str, required=False, default='fast', choices=['fast', 'cwt'], help='Peak finding of frequency selection')
+    parser.add_argument('--jobs', '-j', type=int, required=False, default=1, help='Worker processes to score curring runs')
+    parser.add_argument('--peak-columns', type=int, required=False, default=10000, help='Spectrogram columns to vote for frequencies, 0 for all')
     return parser.parse_args()
 '''
 @param ovenName,axisName
@@ -53,7 +56,7 @@ def checkArgument(ovenName,axisName):
     if not (ovenName == 'OA' or  ovenName == 'OB' or ovenName == 'OC'):
         logger.error('oven name argument error')
         exit(1)
-    if not(axisName == 'X' or axisName == 'Y' or axisName == 'Z'):
+    if not(axisName == 'X' or axisName == 'Y' or axisName == 'Z' or axisName == 'all'):
         logger.error('axis name argument error')
         exit(1)
 '''
@@ -92,22 +95,13 @@ def checkFile(fileList):
 def findCurringData(ovenName, recipeName):
 
     logger.info('Start find curring data')
-    # find curring data files
-    filePath =  os.path.join('.', curingPath , 'Calc_' + ovenName + '*')
+    # find curring data files satisfy param from the recipe index
     try:
-        files = glob.glob(filePath)
+        fileDataFrame = findCuringFiles(os.path.join('.', curingPath), 'Calc_' + ovenName + '*', recipe=recipeName)
     except Exception as e:
         logger.error('Wrong curingPath')
         exit(1)
-    
-    # return curring data files name satisfy param 
-    files.sort()
-    fileDataFrame = pd.DataFrame(columns=['filename','curringname'])
-    for filename in files:
-        receta = pd.read_csv(filename, encoding='ISO-8859-1', nrows=0).columns[1]
-        fileDataFrame = fileDataFrame.append({'filename':filename,'curringname':receta}, ignore_index=True)
-    curringData = fileDataFrame.loc[(fileDataFrame['curringname'] == recipeName), ['filename']] 
-    curringData = curringData.reset_index(drop=True)
+    curringData = fileDataFrame[['filename']]
     if curringData.size == 0:
         logger.error('No curring data match recipe')
         exit(1)
@@ -122,9 +116,7 @@ def processCurringData(filePath, OvenName, sensorType):
 
     # read curring csv to dataframe
     try:
-        receta = pd.read_csv(filePath, encoding='ISO-8859-1', nrows=0).columns[1]
-        cur_pd = pd.read_csv(filePath, encoding='ISO-8859–1', skiprows=[0,1,2,4])
-        cur_pd = cur_pd.drop(columns=cur_pd.columns[-1], axis=1)
+        receta, cur_pd = readCuringFile(filePath)
         if cur_pd.shape[0] == 0:
             logger.error('load ' + filePath + ' is nodata!')
             exit(1)
@@ -132,108 +124,40 @@ def processCurringData(filePath, OvenName, sensorType):
         logger.error('load ' + filePath + ' fail!')
         exit(1)
     
-    curing  = cur_pd
-    columns = ['PMV', 'AMV']
-    curing_timestamp = [time.strftime( "%Y-%m-%d", time.strptime(fecha, "%d/%m/%Y"))+' '+hora for fecha,hora in zip(curing.Fecha, curing.Hora)]
-    if not 'timestamp' in columns:
-        columns = ['timestamp'] + columns
-    cur_pd = curing.assign(timestamp=curing_timestamp)[ columns ]
-    cur_pd['timestamp'] = pd.to_datetime(cur_pd['timestamp'])
+    cur_pd = cur_pd[['timestamp', 'PMV', 'AMV']]
     start_time = cur_pd.loc[0,'timestamp'] + datetime.timedelta(hours=1)
     end_time = cur_pd.loc[cur_pd.index[-1],'timestamp'] - datetime.timedelta(hours=1)
-    start_time_str = start_time.strftime("%Y-%m-%d_%H%M")
-    end_time_str = end_time.strftime("%Y-%m-%d_%H%M")
-    
     
     # find vibration data index
-    vibrationFileName = start_time_str[0:10]
     sensorCode = sensorLabel[OvenName]
     if OvenName == 'OB':
         if sensorType == 'vacuum':
             sensorCode = '500404'
         elif sensorType == 'water':
             sensorCode = '500405'
-    vibrationFilePath = os.path.join('.',vibrationPath,vibrationFileName,'*'+sensorCode + '.csv')
-    files = []
-    
-    if not(start_time_str[0:10] == end_time_str[0:10]) :
-        vibrationFileNameDay1 = start_time_str[0:10]
-        vibrationFileNameDay2 = end_time_str[0:10] 
-        
-        vibrationFilePathDay1 = os.path.join('.',vibrationPath,vibrationFileNameDay1,'*'+sensorCode + '.csv')
-        vibrationFilePathDay2 = os.path.join('.',vibrationPath,vibrationFileNameDay2,'*'+sensorCode + '.csv')
-        try:
-            filesDay1 = glob.glob(vibrationFilePathDay1)
-            filesDay1.sort()
-            startAppend = 0
-            for i, filename in enumerate(filesDay1):
-                if start_time_str in filename:
-                    startAppend = 1
-                if startAppend == 1:
-                    files.append(filename)
-                    
-            filesDay2 = glob.glob(vibrationFilePathDay2)
-
-            filesDay2.sort()
-            startAppend = 1
-            for i, filename in enumerate(filesDay2):
-                if end_time_str in filename:
-                    startAppend = 0
-                if startAppend == 1:
-                    files.append(filename)
-        except Exception as e :
-            print('load ' + vibrationFilePath + ' fail!')
-            exit(1)
-    else:
-        vibrationFileName = start_time_str[0:10]
-        vibrationFilePath = os.path.join('.',vibrationPath,vibrationFileName,'*'+sensorCode + '.csv')
-        try:
-            files = glob.glob(vibrationFilePath)
-            files.sort()
-        
-            start_index = 0
-            end_index = 0
-            for i, filename in enumerate(files):
-                if start_time_str in filename:
-                    start_index = i
-                elif end_time_str in filename:
-                    end_index = i
-        
-            if len(files) == 0 or end_index <= start_index:
-                print(vibrationFilePath+' error')
-                return [-1]
-        
-        except Exception as e :
-            print('load ' + vibrationFilePath + ' fail!')
-            exit(1)
-            
-        files = files[start_index:end_index]
+    try:
+        files = findVibrationFiles(os.path.join('.',vibrationPath), sensorCode, start_time, end_time)
+    except Exception as e :
+        logger.error('load ' + vibrationPath + ' fail!')
+        exit(1)
     if len(files)  == 0:
+        logger.warning('no vibration file of ' + sensorCode + ' from ' + str(start_time) + ' to ' + str(end_time))
         return [-1]
     return files
 
 
 '''
-@param  list of vibration data file , training axis
-@return isolation_model,first_min_max_scaler,second_min_max_scaler,frequencySelect
+@param  list of vibration data file , training axis, peak finding method ('fast' or 'cwt'), spectrogram columns to vote (None for all), spectrogram of the files if already computed
+@return bundle of first_scaler, pca, second_scaler, isolation_model, frequency
 '''
-def training_isolation_forest(vibationFileList,axis):
-    logger.info('Start train isolation forest')
+def training_isolation_forest(vibationFileList,axis,peakMethod='fast',peakColumns=10000,spectrogram=None):
+    logger.info('Start train isolation forest of axis '+axis)
 
-    vibData = np.array([])
-    for filename in vibationFileList :
-        df = pd.read_csv(filename,names=['id','timestamp','X','Y','Z','index'])
-        vibData = np.append(vibData,df[axis].values*1000)
-    f, t, Sxx = signal.spectrogram(vibData, 1000,scaling = 'spectrum' , window = signal.get_window(('tukey',0.125),512),noverlap = 0)
+    if spectrogram is None:
+        spectrogram = vibrationSpectrogram(vibationFileList, axis, 1000, nperseg=512, noverlap=0, cacheDir=spectrogramCachePath)
+    f, t, Sxx = spectrogram
     
-    ans = np.zeros((Sxx[:,1].size,), dtype=int)
-    i = 0
-    for column in Sxx.T:
-        if i == 10000:
-            break
-        i = i + 1
-        peakind = signal.find_peaks_cwt(column, np.arange(1,10))
-        ans[peakind]  = ans[peakind] + 1
+    ans = peakFrequencyVotes(Sxx, np.arange(1,10), maxColumns=peakColumns, method=peakMethod)
     frequencySelect = np.argpartition(ans , -4)[-4:]
     trainData = pd.DataFrame({'0':Sxx[frequencySelect[0],:],'1':Sxx[frequencySelect[1],:],'2':Sxx[frequencySelect[2],:],'3':Sxx[frequencySelect[3],:]})
     
@@ -254,60 +178,79 @@ def training_isolation_forest(vibationFileList,axis):
     isolation_model =  IsolationForest(contamination = outliers_fraction,behaviour='new')
     isolation_model.fit(trainData)
 
-    return isolation_model,first_min_max_scaler,second_min_max_scaler,frequencySelect
+    return {
+        'first_scaler': first_min_max_scaler, 'pca': pca, 'second_scaler': second_min_max_scaler,
+        'isolation_model': isolation_model, 'frequency': [int(i) for i in frequencySelect]
+    }
+
+# trained model of the scoring workers, set once per process by _setScoringModel
+_scoringModel = None
+
+def _setScoringModel(model):
+    global _scoringModel
+    _scoringModel = model
 
 '''
-@param  list of vibration data file , training axis
-@return isolation_model,first_min_max_scaler,second_min_max_scaler,curringData,frequencySelect,axis,oven
+@param  curring data file
+@return curring data file, anomaly rate of each axis (dict) or None if the run can not be scored
 '''
-def testing_isolation_forest(isolation_model,first_min_max_scaler,second_min_max_scaler,curringData,frequencySelect,axis,oven, sensortype):
-    logger.info('Testing train isolation forest')
-    test_files = curringData['filename'].tolist()
-    anomaly_list = []
-    anomaly_name = []
-    for i, val in enumerate(test_files):
-        try:
-            vibationFileList  = processCurringData(val,oven, sensortype)
-            if vibationFileList[0] == -1:
-                logger.warning(val+' data cross day or vibration file not exist')
-                continue
-            
-            vibData = np.array([])
-            for filename in vibationFileList :
-                df = pd.read_csv(filename,names=['id','timestamp','X','Y','Z','index'])
-                vibData = np.append(vibData,df[axis].values*1000)
-            f, t, Sxx = signal.spectrogram(vibData, 1000,scaling = 'spectrum' , window = signal.get_window(('tukey',0.125),512),noverlap = 0)
+def score_curring_run(val):
+    bundles,oven,sensortype = _scoringModel
+    try:
+        vibationFileList  = processCurringData(val,oven, sensortype)
+        if vibationFileList[0] == -1:
+            logger.warning(val+' data cross day or vibration file not exist')
+            return val, None
+        
+        # one pass over the files for every axis, only the selected frequencies are kept
+        spectrograms = vibrationSpectrograms(vibationFileList, list(bundles.keys()), 1000, nperseg=512, noverlap=0,
+            bins={axis: bundle['frequency'] for axis, bundle in bundles.items()}, cacheDir=spectrogramCachePath)
 
-            testData = pd.DataFrame({'0':Sxx[frequencySelect[0],:],'1':Sxx[frequencySelect[1],:],'2':Sxx[frequencySelect[2],:],'3':Sxx[frequencySelect[3],:]})
+        anomaly_scores = {}
+        for axis, bundle in bundles.items():
+            f, t, Sxx = spectrograms[axis]
+            testData = pd.DataFrame({'0':Sxx[0,:],'1':Sxx[1,:],'2':Sxx[2,:],'3':Sxx[3,:]})
             test_temp = pd.DataFrame({'timestamp':t})
-            # first scaler
-            first_np_scaled = first_min_max_scaler.transform(testData)
-            testData = pd.DataFrame(first_np_scaled)
-
-            # PCA
-            pca = PCA(n_components=2)
-            testData = pca.fit_transform(testData)
+            # scaler, the PCA fitted in training, scaler, isolation forest
+            test_temp['anomaly'], test_temp['anomalyscore'] = scoreVibrationModel(bundle, testData)
 
-            #second scaler
-            second_np_scaled = second_min_max_scaler.transform(testData)
-            testData = pd.DataFrame(second_np_scaled)
-            
-            test_temp['anomaly']      = isolation_model.predict(testData)
-            test_temp['anomalyscore'] = isolation_model.score_samples(testData)
-            test_temp['anomaly']      = test_temp['anomaly'].map( {1: 0, -1: 1} )
+            anomaly_scores[axis] = anomalyRate(test_temp['anomaly'].values)
+            logger.info('curring data: '+val+' axis '+axis+' anomaly rate: '+str(anomaly_scores[axis]))
+        return val, anomaly_scores
+    except (Exception, SystemExit) as e :
+        # processCurringData exits on a bad curing file, the run is skipped instead, serial or in a worker
+        print(e)
+        logger.warning(val+' test fail!')
+        return val, None
 
-            anomaly_number = test_temp['anomaly'].value_counts()
-            try:
-                anomaly_score = anomaly_number[1] / anomaly_number[0]
-            except Exception as e :
-                anomaly_score = 0
-            anomaly_name.append(val)
-            anomaly_list.append(anomaly_score)
-            logger.info('curring data: '+val+' anomaly rate: '+str(anomaly_score))
-        except Exception as e :
-            print(e)
-            logger.warning(val+' test fail!')
-            continue
+'''
+@param  bundle of the trained model of each axis (dict),curringData,oven,sensortype,number of worker processes
+@return anomaly_name,anomaly_list of each axis (dict)
+'''
+def testing_isolation_forest(bundles,curringData,oven, sensortype, jobs=1):
+    logger.info('Testing train isolation forest')
+    test_files = curringData['filename'].tolist()
+    anomaly_list = {axis: [] for axis in bundles}
+    anomaly_name = []
+    model = (bundles,oven,sensortype)
+    if jobs > 1 and len(test_files) > 1:
+        # runs are scored in worker processes, results come back in the order of test_files
+        executor = ProcessPoolExecutor(max_workers=jobs, initializer=_setScoringModel, initargs=(model,))
+        results = executor.map(score_curring_run, test_files)
+    else:
+        executor = None
+        _setScoringModel(model)
+        results = (score_curring_run(val) for val in test_files)
+    try:
+        for val, anomaly_scores in results:
+            if anomaly_scores is not None:
+                anomaly_name.append(val)
+                for axis in bundles:
+                    anomaly_list[axis].append(anomaly_scores[axis])
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        _setScoringModel(None)
     return anomaly_name,anomaly_list
 '''
 @param  anomaly filePath
@@ -339,16 +282,26 @@ def main():
         logger.error('vibration file error')
         exit(1)
     
-    # train isoltion forest
-    isolation_model,first_min_max_scaler,second_min_max_scaler,frequencySelect = training_isolation_forest(vibationFileList,args.axis)
+    # train isoltion forest, the spectrograms of every axis come from one pass over the files
+    axes = vibrationAxes if args.axis == 'all' else [args.axis]
+    spectrograms = vibrationSpectrograms(vibationFileList, axes, 1000, nperseg=512, noverlap=0, cacheDir=spectrogramCachePath)
+    bundles = {}
+    for axis in axes:
+        bundles[axis] = training_isolation_forest(vibationFileList,axis,args.peak_method,args.peak_columns if args.peak_columns > 0 else None,spectrograms[axis])
+    spectrograms = None
     
     # testing
-    anomaly_name,anomaly_list = testing_isolation_forest(isolation_model, first_min_max_scaler, second_min_max_scaler, curringData, frequencySelect, args.axis,args.oven,args.type)
+    anomaly_name,anomaly_list = testing_isolation_forest(bundles, curringData, args.oven,args.type,args.jobs)
     
-    baseName = [args.recipe, args.oven, args.axis]
-    if args.type != "fan":
-        baseName.insert(2, args.type)
-    baseName = '-'.join(baseName)
+    for axis in axes:
+        store_vibration_model(args.recipe, args.oven, args.type, axis, bundles[axis], anomaly_name, anomaly_list[axis])
+
+'''
+@param  recipe, oven, type, axis, bundle of the trained model, anomaly_name, anomaly_list
+@return 
+'''
+def store_vibration_model(recipe, oven, sensortype, axis, bundle, anomaly_name, anomaly_list):
+    baseName = vibrationModelName(recipe, oven, axis, sensortype)
     # store anomaly rate
 
     anomalyFileName = baseName + '.csv'
@@ -357,42 +310,16 @@ def main():
     storeDataFrame  = pd.DataFrame({'name' : anomaly_name,'anomaly_score':anomaly_list  })
     storeDataFrame.to_csv(anomalyFilePath , sep=',')
     
-    # store model
-    modelFstName   = baseName + '-fst.pkl'
-    modelSecName   = baseName + '-sec.pkl'
-    modelIosName   = baseName + '-ios.pkl'
-
-    modelFstPath   = os.path.join('.', modelPath , modelFstName)
-    modelSecPath   = os.path.join('.', modelPath , modelSecName)
-    modelIosPath   = os.path.join('.', modelPath , modelIosName)
-
-    joblib.dump(first_min_max_scaler, modelFstPath)
-    joblib.dump(second_min_max_scaler, modelSecPath)
-    joblib.dump(isolation_model, modelIosPath)
+    # store model, the selected frequencies and the z-score of the anomaly rate go with it
+    mean,std = computeZscore(anomalyFilePath)
+    bundle.update(recipe=recipe, oven=oven, type=sensortype, axis=axis, mean=mean, std=std)
+    saveVibrationModel(os.path.join('.', modelPath), baseName, bundle)
     
     # store select frequency
+    frequencySelect          = bundle['frequency']
     freqencySequence         = str(frequencySelect[0])+';'+str(frequencySelect[1])+';'+str(frequencySelect[2])+';'+str(frequencySelect[3])
     selectFrequencyFilePath  = os.path.join('.', selectFrequencyPath , selectFrequencyName)
-    mean,std                 = computeZscore(anomalyFilePath)
-    selectFrequencyDataFrame = pd.read_csv(selectFrequencyFilePath,names=['recipe', 'type', 'axis','frequency','mean','std'])
-    tempDataFrame            = selectFrequencyDataFrame.loc[selectFrequencyDataFrame['recipe'] == args.recipe]
-    tempDataFrame            = tempDataFrame.loc[tempDataFrame['axis'] == args.axis]
-    tempDataFrame            = tempDataFrame.loc[tempDataFrame['type'] == args.type]
-    addDataFrame             = pd.DataFrame([[args.recipe , args.type, args.axis , freqencySequence , str(mean) , str(std)]], columns=['recipe', 'type', 'axis','frequency','mean','std'])
-    
-    if tempDataFrame.shape[0] == 0:
-        selectFrequencyDataFrame = selectFrequencyDataFrame.append(addDataFrame)
-    elif tempDataFrame.shape[0] == 1:
-        selectFrequencyDataFrame.at[tempDataFrame.index.values[0] , 'recipe']     = args.recipe
-        selectFrequencyDataFrame.at[tempDataFrame.index.values[0] , 'type']       = args.type
-        selectFrequencyDataFrame.at[tempDataFrame.index.values[0] , 'axis']       = args.axis
-        selectFrequencyDataFrame.at[tempDataFrame.index.values[0] , 'frequency']  = freqencySequence 
-        selectFrequencyDataFrame.at[tempDataFrame.index.values[0] , 'mean']       = str(mean)
-        selectFrequencyDataFrame.at[tempDataFrame.index.values[0] , 'std']        = str(std)
-    else:
-        logger.warning('same value of Select_Frequency.csv')
-    
-    selectFrequencyDataFrame.to_csv(selectFrequencyFilePath, header=False, index=False , sep=',')
+    upsertSelectFrequency(selectFrequencyFilePath, recipe, sensortype, axis, freqencySequence, mean, std)
     logger.info('store Select_Frequency.csv sucessfully')
 
 if __name__ == '__main__':